@@ -0,0 +1,49 @@
+import threading
+import time
+
+import pytest
+
+from weebtools.images import api
+from weebtools.images.yande import Yande
+from weebtools.weebException import WeebException
+
+
+LINKS = [ f'https://yande.re/post/show/{x}' for x in range(1,41) ]
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path,monkeypatch):
+    monkeypatch.setattr(Yande,'imgFolder',tmp_path / 'images')
+    monkeypatch.setattr(Yande,'failFile',tmp_path / 'fail.json')
+
+@pytest.fixture
+def downloaded(monkeypatch):
+    downloaded = []
+    lock = threading.Lock()
+
+    def _download_single(self,piclink):
+        time.sleep(0.01)
+        with lock:
+            downloaded.append(piclink)
+
+    monkeypatch.setattr(Yande,'download_single',_download_single)
+    return downloaded
+
+
+def test_yields_every_link(tmp_path,downloaded):
+    results = list(api.iter_download(LINKS,tag_db=tmp_path / 'tags.db',workers=4))
+    assert sorted(x.link for x in results) == sorted(LINKS)
+    assert all(x.ok for x in results)
+
+def test_bad_options_raise(tmp_path):
+    with pytest.raises(WeebException,match='Unknown schedule'):
+        list(api.iter_download(LINKS,tag_db=tmp_path / 'tags.db',schedule='bogus'))
+
+def test_stopping_iteration_stops_downloads(tmp_path,downloaded):
+    for res in api.iter_download(LINKS,tag_db=tmp_path / 'tags.db',workers=2,window=2):
+        break
+    time.sleep(0.2)
+    n = len(downloaded)
+    assert n < len(LINKS)
+    time.sleep(0.1)
+    assert len(downloaded) == n
@@ -0,0 +1,24 @@
+import pytest
+import requests
+
+from weebtools.images.failures import FailLog
+from weebtools.weebException import WeebException
+
+
+@pytest.mark.parametrize('e,expected',[
+    (WeebException('pic.png File size mismatch 1000 != 404'),('checksum',None)),
+    (WeebException('md5 checksum failure'),('checksum',None)),
+    (WeebException('Image file_url error: 404',status=404),('http',404)),
+    (WeebException('Post 123 503',status=503),('http',503)),
+    (WeebException('Invalid link x yande single'),('invalid',None)),
+    (requests.ConnectionError(),('ConnectionError',None)),
+    (WeebException('Everything up to date'),('other',None)),
+])
+def test_classify(e,expected):
+    assert FailLog.classify(e) == expected
+
+def test_size_mismatch_not_permanent(tmp_path):
+    log = FailLog(tmp_path / 'fail.json')
+    log.record('https://yande.re/post/show/1','yande',WeebException('File size mismatch 1000 != 404'))
+    entry = log.entries['https://yande.re/post/show/1']
+    assert entry['status'] is None and not entry['permanent']
@@ -0,0 +1,153 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from weebtools.images.jobQueue import JobQueue
+
+
+LINKS = [ f'https://yande.re/post/show/{x}' for x in range(10) ]
+
+
+@pytest.fixture
+def dbFile(tmp_path):
+    return tmp_path / 'queue.db'
+
+def getJob(jq,link):
+    with jq._connect() as db:
+        return db.execute('SELECT state,owner,attempts FROM jobs WHERE link = ?',(link,)).fetchone()
+
+def expire(jq,link):
+    with jq._transaction() as db:
+        db.execute('UPDATE jobs SET leaseUntil = ? WHERE link = ?',(time.time()-1,link))
+
+
+def test_add_ignores_queued_links(dbFile):
+    jq = JobQueue(dbFile,owner='a')
+    assert jq.add(LINKS,'yande','single') == 10
+    assert jq.add(LINKS[:3],'yande','single') == 0
+    assert jq.status() == {'pending': 10}
+
+def test_add_requeues_finished_links(dbFile):
+    jq = JobQueue(dbFile,owner='a')
+    jq.add(LINKS[:2],'yande','artist',{'update': True})
+    jq.lease(2,'artist')
+    jq.complete(LINKS[0])
+    assert jq.add(LINKS[:2],'yande','artist',{'reconcile': True}) == 1
+    assert jq.status() == {'leased': 1, 'pending': 1}
+    assert jq.lease(1,'artist') == [ (LINKS[0],'yande',{'reconcile': True}) ]
+    assert getJob(jq,LINKS[0]) == ('leased','a',1)
+
+def test_leased_jobs_not_leased_again(dbFile):
+    a, b = JobQueue(dbFile,owner='a'), JobQueue(dbFile,owner='b')
+    a.add(LINKS,'yande','single')
+
+    leasedA = [ x[0] for x in a.lease(6,'single') ]
+    leasedB = [ x[0] for x in b.lease(6,'single') ]
+    assert len(leasedA) == 6 and len(leasedB) == 4
+    assert not set(leasedA) & set(leasedB)
+    assert b.lease(6,'single') == []
+
+def test_lease_by_kind(dbFile):
+    jq = JobQueue(dbFile,owner='a')
+    jq.add(LINKS[:1],'yande','artist',{'update': True})
+    assert jq.lease(5,'single') == []
+    assert jq.lease(5,'artist') == [ (LINKS[0],'yande',{'update': True}) ]
+
+def test_concurrent_leases_never_overlap(dbFile):
+    JobQueue(dbFile,owner='setup').add([ f'{x}/{i}' for x in LINKS for i in range(20) ],'yande','single')
+    leased = {}
+
+    def _work(owner):
+        jq = JobQueue(dbFile,owner=owner)
+        mine = []
+        while jobs := jq.lease(3,'single'):
+            mine += [ x[0] for x in jobs ]
+        leased[owner] = mine
+
+    threads = [ threading.Thread(target=_work,args=(f'w{x}',)) for x in range(4) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    allLeased = [ x for v in leased.values() for x in v ]
+    assert len(allLeased) == len(set(allLeased)) == 200
+
+def test_expired_lease_goes_to_another_worker(dbFile):
+    a, b = JobQueue(dbFile,owner='a'), JobQueue(dbFile,owner='b')
+    a.add(LINKS[:1],'yande','single')
+    a.lease(1,'single')
+    assert b.lease(1,'single') == []
+
+    expire(a,LINKS[0])
+    assert [ x[0] for x in b.lease(1,'single') ] == LINKS[:1]
+    assert getJob(b,LINKS[0]) == ('leased','b',2)
+
+def test_expired_lease_fails_after_max_attempts(dbFile):
+    jq = JobQueue(dbFile,owner='a')
+    jq.add(LINKS[:1],'yande','single')
+    for _ in range(jq.maxAttempts):
+        assert jq.lease(1,'single')
+        expire(jq,LINKS[0])
+    assert jq.lease(1,'single') == []
+    assert getJob(jq,LINKS[0]) == ('failed','a',jq.maxAttempts)
+
+def test_old_owner_cant_finish_released_job(dbFile):
+    a, b = JobQueue(dbFile,owner='a'), JobQueue(dbFile,owner='b')
+    a.add(LINKS[:1],'yande','single')
+    a.lease(1,'single')
+    expire(a,LINKS[0])
+    b.lease(1,'single')
+
+    a.complete(LINKS[0])
+    assert getJob(a,LINKS[0])[:2] == ('leased','b')
+    b.complete(LINKS[0])
+    assert getJob(b,LINKS[0])[:2] == ('done','b')
+
+def test_fail_retries_until_max_attempts(dbFile):
+    jq = JobQueue(dbFile,owner='a')
+    jq.add(LINKS[:1],'yande','single')
+    for n in range(1,jq.maxAttempts+1):
+        assert jq.lease(1,'single')
+        jq.fail(LINKS[0],'boom')
+        assert getJob(jq,LINKS[0])[0] == ('failed' if n == jq.maxAttempts else 'pending')
+    assert jq.lease(1,'single') == []
+
+def test_heartbeat_extends_leases(dbFile,monkeypatch):
+    monkeypatch.setattr(JobQueue,'leaseTime',0.3)
+    jq = JobQueue(dbFile,owner='a')
+    jq.add(LINKS[:1],'yande','single')
+    jq.lease(1,'single')
+
+    jq.startHeartbeat()
+    try:
+        time.sleep(0.6)
+        assert JobQueue(dbFile,owner='b').lease(1,'single') == []
+    finally:
+        jq.stopHeartbeat()
+
+def test_heartbeat_survives_locked_db(dbFile,monkeypatch):
+    monkeypatch.setattr(JobQueue,'leaseTime',0.3)
+    jq = JobQueue(dbFile,owner='a')
+    jq.add(LINKS[:1],'yande','single')
+    jq.lease(1,'single')
+
+    transaction = jq._transaction
+    calls = []
+
+    def _locked():
+        calls.append(1)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        return transaction()
+
+    monkeypatch.setattr(jq,'_transaction',_locked)
+    jq.startHeartbeat()
+    try:
+        time.sleep(0.5)
+        assert jq._heartbeat.is_alive()
+        assert len(calls) > 1
+    finally:
+        jq.stopHeartbeat()
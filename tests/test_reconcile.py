@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from weebtools.images.yande import Yande
+
+
+POSTS = range(1,11)
+
+
+def piclink(postID):
+    return f'https://yande.re/post/show/{postID}'
+
+@pytest.fixture
+def yande(tmp_path,monkeypatch):
+    monkeypatch.setattr(Yande,'imgFolder',tmp_path / 'images')
+    monkeypatch.setattr(Yande,'failFile',tmp_path / 'fail.json')
+    d = Yande(interactive=False,progress=False,verbose=False,tag_db=tmp_path / 'tags.db')
+    yield d
+    d.close()
+
+@pytest.fixture
+def artistDir(yande):
+    artistDir = yande.imgFolder / 'artist'
+    (artistDir / 'source').mkdir(parents=True)
+    (artistDir / 'jpg').mkdir()
+    for x in POSTS:
+        (artistDir / 'jpg' / f'yande.re {x} artist.jpg').write_bytes(b'pic')
+    (artistDir / 'source' / 'info.json').write_text(json.dumps(
+        {'piclinks': {'yande': [ piclink(x) for x in POSTS ]},'explicit': {'yande': [ piclink(9) ]}}))
+    return artistDir
+
+def stubGone(monkeypatch,gone):
+    checked = []
+
+    def _isGone(self,s,postID):
+        checked.append(postID)
+        return postID in gone
+
+    monkeypatch.setattr(Yande,'isGone',_isGone)
+    return checked
+
+
+def test_partial_crawl_keeps_posts_still_on_site(yande,artistDir,monkeypatch):
+    # only the first page made it, the rest of the listing is missing
+    checked = stubGone(monkeypatch,gone={9})
+    todo = yande.reconcileArtist('artist',[ piclink(x) for x in POSTS[:3] ])
+
+    assert todo == []
+    assert sorted(checked) == list(range(4,11))
+    assert yande.pruned == [9]
+    assert sorted(x.name for x in (artistDir / 'jpg').iterdir()) == sorted(
+        f'yande.re {x} artist.jpg' for x in POSTS if x != 9)
+    info = json.loads((artistDir / 'source' / 'info.json').read_text())
+    assert info['piclinks']['yande'] == [ piclink(x) for x in POSTS if x != 9 ]
+    assert info['explicit']['yande'] == []
+
+def test_unchecked_posts_are_kept(yande,artistDir,monkeypatch):
+    def _isGone(self,s,postID):
+        raise ConnectionError('offline')
+
+    monkeypatch.setattr(Yande,'isGone',_isGone)
+    yande.reconcileArtist('artist',[ piclink(1) ])
+
+    assert yande.pruned == []
+    assert len(list((artistDir / 'jpg').iterdir())) == len(POSTS)
+
+def test_empty_crawl_raises(yande,artistDir):
+    with pytest.raises(Exception,match='Nothing crawled'):
+        yande.reconcileArtist('artist',[])
@@ -1,9 +1,17 @@
 import argparse
+import json
 import re
 import sys
+import time
 
 from . import utils
+from .images.fileWriter import AtomicWriter
+from .images.api import getLinkType, plan
 from .images.imageDownloader import ImageDownloader
+from .images.jobQueue import JobQueue
+from .images.scheduler import policies
+from .images.tagIndex import TagIndex
+from .images.watcher import Watcher
 from .images.yande import Yande
 from .images.pixiv import Pixiv
 from .weebException import WeebException
@@ -19,26 +27,68 @@ def main_utils(args):
     if args.downloadChromeDriver:
         utils.downloadChromeDriver()
 
+    if args.rewrapKey:
+        utils.rewrapKey(args.rewrapKey)
+
 def main_img(args):
+    if args.retry_failed:
+        for downloader in (Yande,Pixiv):
+            d = downloader(interactive=False,**getRunOptions(args))
+            try:
+                if d.failLog.retryable(d.site):
+                    d.retry_failed()
+                    d.printSummary('retry')
+            finally:
+                d.close()
+        return
+
+    if not args.url:
+        raise WeebException('url is required')
+
+    if args.plan:
+        plans = plan([args.url],
+            update=args.update,
+            update_all=args.update_all,
+            reconcile=args.reconcile,
+            plan_sizes=args.plan_sizes,
+            workers=args.workers)
+        print(json.dumps(plans[0],indent=4))
+        return
+
     if ImageDownloader.checkValid(args.url,'yande','single'):
-        yande = Yande()
-        yande.download_single(args.url)
+        yande = Yande(**getRunOptions(args))
+        try:
+            yande.download_single(args.url)
+        finally:
+            yande.close()
         yande.printSummary('single')
     elif ImageDownloader.checkValid(args.url,'yande','artist'):
         yande = Yande(
             update=args.update,
             update_all=args.update_all,
+            reconcile=args.reconcile,
+            resume=args.resume,
+            **getRunOptions(args),
         )
-        yande.download_artist(args.url)
+        try:
+            yande.download_artist(args.url)
+        finally:
+            yande.close()
         yande.printSummary('artist')
     elif ImageDownloader.checkValid(args.url,'pixiv','single'):
-        pix = Pixiv()
-        pix.download_single(args.url)
+        pix = Pixiv(**getRunOptions(args))
+        try:
+            pix.download_single(args.url)
+        finally:
+            pix.close()
         pix.printSummary('single')
     elif ImageDownloader.checkValid(args.url,'pixiv','artist'):
         pix = Pixiv(
             update=args.update,
             update_all=args.update_all,
+            reconcile=args.reconcile,
+            resume=args.resume,
+            **getRunOptions(args),
         )
         try:
             pix.download_artist(args.url)
@@ -48,6 +98,79 @@ def main_img(args):
     else:
         raise WeebException(f'Unsupported url: {args.url}')
 
+def main_queue(args):
+    jq = JobQueue(args.db)
+
+    if args.add:
+        added = 0
+        for link in args.add:
+            site, linkType = getLinkType(link)
+            options = {
+                'update': args.update,
+                'update_all': args.update_all,
+                'reconcile': args.reconcile,
+            } if linkType == 'artist' else {}
+            added += jq.add([link],site,linkType,options)
+        print(f'Queued {added} links in {jq.dbFile} (new, done or failed)')
+
+    if args.work:
+        print(f'Working {jq.dbFile} as {jq.owner}')
+        jq.work(poll=args.poll,**getRunOptions(args))
+
+    if args.status or not (args.add or args.work):
+        status = jq.status()
+        print('\n'.join(f'{k}: {v}' for k,v in sorted(status.items())) or 'Queue is empty')
+
+def main_query(args):
+    ti = TagIndex(args.db)
+
+    if args.rebuild:
+        print(f'Indexing {ImageDownloader.imgFolder}',flush=True)
+        print(f'Indexed {ti.rebuild(ImageDownloader.imgFolder)} pics')
+        return
+
+    start = time.perf_counter()
+    results = ti.query(args.tags,args.artist,args.rating,args.site,args.limit)
+    took = (time.perf_counter() - start) * 1000
+
+    for r in results:
+        if args.long:
+            page = f' p{r["page"]}' if r['site'] == 'pixiv' else ''
+            print(f'{r["site"]} {r["postID"]}{page} {r["artist"]} {r["rating"] or "-"} {r["picture"]}')
+        else:
+            print(r['picture'])
+    print(f'{len(results)} results in {took:.1f} ms',file=sys.stderr)
+
+def main_watch(args):
+    w = Watcher(args.config,**getRunOptions(args))
+
+    if args.add:
+        w.add(args.add)
+    if args.remove:
+        w.remove(args.remove)
+    if args.list:
+        for link in w.follow:
+            entry = w.state[link]
+            nextCheck = time.strftime('%m-%d-%Y %I:%M:%S %p',time.localtime(entry['nextCheck'])) \
+                if entry['nextCheck'] else 'on start'
+            print(f'{link} every {entry["interval"]/60:.0f} min, next check {nextCheck}')
+    if args.add or args.remove or args.list:
+        return
+
+    w.run(once=args.once)
+
+def getRunOptions(args):
+    return {
+        'workers': args.workers,
+        'progress': not args.no_progress,
+        'stats_file': args.stats_file,
+        'segment_threshold': args.segment_threshold * 2**20,
+        'fsync': args.fsync,
+        'schedule': args.schedule,
+        'max_rate': args.max_rate * 2**20 if args.max_rate else None,
+        'tag_db': args.tag_db,
+    }
+
 def getDescription(downloader):
     descrip = ''
     for sv in downloader.valid.values():
@@ -76,9 +199,13 @@ if __name__ == '__main__':
     utilsParser.add_argument('--downloadChromeDriver',
         action='store_true',
         help='Download latest ChromeDriver')
+    utilsParser.add_argument('--rewrapKey',
+        choices=['rsa','file'],
+        help='Change how the login encryption key is stored, file skips the slow RSA key')
 
     parent_subparser = argparse.ArgumentParser(add_help=False)
     parent_subparser.add_argument('url',
+        nargs='?',
         help='Top level url')
     group = parent_subparser.add_mutually_exclusive_group()
     group.add_argument('-u','--update',
@@ -87,12 +214,139 @@ if __name__ == '__main__':
     group.add_argument('-ua','--update_all',
         action='store_true',
         help='Downloads any missing data')
+    group.add_argument('--reconcile',
+        action='store_true',
+        help='Syncs an existing artist folder: downloads missing / broken pics, removes deleted posts')
+    parent_subparser.add_argument('--retry_failed',
+        action='store_true',
+        help='Retry failures from previous runs, no url needed')
+    parent_subparser.add_argument('-r','--resume',
+        action='store_true',
+        help='Continue an artist download that stopped halfway')
+    parent_subparser.add_argument('--plan',
+        action='store_true',
+        help='Print what an artist run would download (json), nothing is downloaded')
+    parent_subparser.add_argument('--plan_sizes',
+        action='store_true',
+        help='With --plan, HEAD requests for pixiv sizes (yande.re sizes come from the listing)')
+
+    options_subparser = argparse.ArgumentParser(add_help=False)
+    options_subparser.add_argument('-w','--workers',
+        type=int,
+        default=4,
+        help='Number of concurrent downloads (default: 4)')
+    options_subparser.add_argument('--segment_threshold',
+        type=int,
+        default=16,
+        metavar='MB',
+        help='yande.re pics at least this big are downloaded in 4 parallel parts (default: 16)')
+    options_subparser.add_argument('--fsync',
+        choices=AtomicWriter.fsyncPolicies,
+        default='never',
+        help='Flush pics to disk before / after they get their final name (default: never)')
+    options_subparser.add_argument('--schedule',
+        choices=list(policies),
+        default='crawl',
+        help='Download order: crawl, newest (post id) first, smallest first, '
+             'or lanes (big files kept to a quarter of the workers) (default: crawl)')
+    options_subparser.add_argument('--max_rate',
+        type=float,
+        metavar='MB/s',
+        help='Bandwidth cap over every concurrent download')
+    options_subparser.add_argument('--tag_db',
+        default=TagIndex.defaultFile,
+        metavar='FILE',
+        help=f'Tag index sqlite file pics are added to, local disk (default: {TagIndex.defaultFile})')
+    options_subparser.add_argument('--no_progress',
+        action='store_true',
+        help='Print every pic instead of the live progress line')
+    options_subparser.add_argument('--stats_file',
+        help='Json file to keep updated with download stats (monitoring)')
 
     imageParser = subparsers.add_parser('img',
         formatter_class=argparse.RawTextHelpFormatter,
-        parents=[parent_subparser],
+        parents=[parent_subparser,options_subparser],
         description=getDescription(ImageDownloader))
 
+    queueParser = subparsers.add_parser('queue',
+        parents=[options_subparser],
+        description='Job queue shared by several weebtools processes on this box')
+    queueParser.add_argument('--db',
+        default=JobQueue.defaultFile,
+        help=f'Queue sqlite file, local disk only, sqlite locks are unreliable on network shares (default: {JobQueue.defaultFile})')
+    queueParser.add_argument('--add',
+        nargs='+',
+        metavar='URL',
+        help='Queue single / artist links')
+    queueGroup = queueParser.add_mutually_exclusive_group()
+    queueGroup.add_argument('-u','--update',
+        action='store_true',
+        help='Queued artists only get their latest data')
+    queueGroup.add_argument('-ua','--update_all',
+        action='store_true',
+        help='Queued artists get any missing data')
+    queueGroup.add_argument('--reconcile',
+        action='store_true',
+        help='Queued artists are synced with the site (missing / broken pics, deleted posts)')
+    queueParser.add_argument('--work',
+        action='store_true',
+        help='Download queued jobs until the queue is empty')
+    queueParser.add_argument('--poll',
+        type=int,
+        default=0,
+        metavar='SECS',
+        help='With --work, keep waiting for new jobs, checking every SECS')
+    queueParser.add_argument('--status',
+        action='store_true',
+        help='Print job counts')
+
+    queryParser = subparsers.add_parser('query',
+        description='Search downloaded pics by tag / artist / rating')
+    queryParser.add_argument('tags',
+        nargs='*',
+        help='Pics must have every tag, tag* matches a prefix')
+    queryParser.add_argument('-a','--artist',
+        help='Artist folder name')
+    queryParser.add_argument('-r','--rating',
+        choices=['s','q','e'],
+        help='s(afe) / q(uestionable) / e(xplicit)')
+    queryParser.add_argument('-s','--site',
+        choices=list(ImageDownloader.valid),
+        help='Only pics from this site')
+    queryParser.add_argument('-n','--limit',
+        type=int,
+        help='Max number of results')
+    queryParser.add_argument('-l','--long',
+        action='store_true',
+        help='Print site, post id, artist and rating too')
+    queryParser.add_argument('--db',
+        default=TagIndex.defaultFile,
+        help=f'Index sqlite file (default: {TagIndex.defaultFile})')
+    queryParser.add_argument('--rebuild',
+        action='store_true',
+        help='Index pics already downloaded, from their file names')
+
+    watchParser = subparsers.add_parser('watch',
+        parents=[options_subparser],
+        description='Keeps polling followed artists and downloads new posts as they appear')
+    watchParser.add_argument('--config',
+        default=Watcher.configFile,
+        help=f'Followed artists json (default: {Watcher.configFile})')
+    watchParser.add_argument('--add',
+        nargs='+',
+        metavar='URL',
+        help='Follow yande.re / pixiv artist links')
+    watchParser.add_argument('--remove',
+        nargs='+',
+        metavar='URL',
+        help='Stop following artist links')
+    watchParser.add_argument('--list',
+        action='store_true',
+        help='Print followed artists with their poll interval')
+    watchParser.add_argument('--once',
+        action='store_true',
+        help='Check every followed artist one time and exit (cron)')
+
     args = parser.parse_args()
 
     if args.version:
@@ -107,5 +361,11 @@ if __name__ == '__main__':
             main_utils(args)
         elif args.command == 'img':
             main_img(args)
+        elif args.command == 'queue':
+            main_queue(args)
+        elif args.command == 'query':
+            main_query(args)
+        elif args.command == 'watch':
+            main_watch(args)
     except WeebException as e:
         sys.exit(e)
@@ -0,0 +1,159 @@
+'''
+Library use without the CLI
+
+>>> from weebtools.images.api import iter_download
+>>> for res in iter_download(['https://yande.re/post/show/123456']):
+...     print(res.ok, res.pictures)
+
+Nothing is asked and downloader logs are off, results are yielded as each pic link completes
+pixiv artist links still need credentials stored by a previous CLI run (getUserPass),
+they raise otherwise, and still open Chrome to crawl
+
+>>> from weebtools.images.api import plan
+>>> sum(x['bytes'] for x in plan(artistlinks,update=True))
+
+plan crawls artist links and diffs them with the local catalog without downloading
+'''
+import dataclasses
+import queue
+import threading
+
+from pathlib import Path
+
+from .imageDownloader import ImageDownloader
+from .pixiv import Pixiv
+from .tagIndex import TagIndex
+from .yande import Yande
+from ..utils import SessionPool
+from ..weebException import WeebException
+
+
+downloaders = {
+    'yande': Yande,
+    'pixiv': Pixiv,
+}
+
+
+@dataclasses.dataclass
+class ImageResult:
+    link: str
+    ok: bool
+    artist: str = None
+    pictures: list[Path] = dataclasses.field(default_factory=list)
+    explicit: bool = False
+    error: Exception = None
+
+
+def getLinkType(link):
+    ''' Returns site, single / artist '''
+    for site,types in ImageDownloader.valid.items():
+        for linkType in types:
+            if ImageDownloader.checkValid(link,site,linkType):
+                return site, linkType
+    raise WeebException(f'Unsupported url: {link}')
+
+def iter_download(links,executor=None,session_pool=None,**kwargs):
+    '''
+    links           - single / artist links, any supported site
+    executor        - concurrent.futures executor to run downloads on (not shut down)
+    session_pool    - utils.SessionPool (or anything with get / put) shared between jobs
+    kwargs          - downloader options (update, update_all, workers, fsync, tag_db...)
+
+    Yields an ImageResult per pic link as it completes
+    Artist links that fail as a whole (up to date, not found...) yield one failed result
+    Anything else going wrong (bad options...) is raised here
+    Stopping the iteration stops submitting downloads, the ones in flight still finish
+    '''
+    grouped = {}
+    for link in links:
+        site, linkType = getLinkType(link)
+        grouped.setdefault(site,{'single': [],'artist': []})[linkType].append(link)
+
+    results = queue.Queue()
+    done = object()
+    stop = threading.Event()
+
+    def _onResult(piclink,pictures,error):
+        results.put(ImageResult(
+            link=piclink,
+            ok=error is None,
+            artist=pictures[0]['artist'] if pictures else None,
+            pictures=[ x['picture'] for x in pictures ],
+            explicit=any(x['explicit'] for x in pictures),
+            error=error,
+        ))
+
+    tagIndex = kwargs.get('tag_index') or TagIndex(kwargs.get('tag_db'))
+    options = {
+        'progress': False,
+        'verbose': False,
+        **kwargs,
+        'interactive': False,
+        'executor': executor,
+        'session_pool': session_pool or SessionPool(),
+        'tag_index': tagIndex,
+        'on_result': _onResult,
+        'stop_event': stop,
+    }
+
+    def _run():
+        try:
+            for site,byType in grouped.items():
+                if stop.is_set():
+                    break
+                d = downloaders[site](**options)
+                try:
+                    if byType['single']:
+                        d.download_many(byType['single'])
+                    for artistlink in byType['artist']:
+                        if stop.is_set():
+                            break
+                        try:
+                            d.download_artist(artistlink)
+                        except Exception as e:
+                            results.put(ImageResult(link=artistlink,ok=False,error=e))
+                finally:
+                    d.close()
+        except Exception as e:
+            # re-raised by the generator
+            results.put(e)
+        finally:
+            if tagIndex is not kwargs.get('tag_index'):
+                tagIndex.close()
+            results.put(done)
+
+    threading.Thread(target=_run,name='weebtools-iter_download',daemon=True).start()
+
+    try:
+        while (res := results.get()) is not done:
+            if isinstance(res,Exception):
+                raise res
+            yield res
+    finally:
+        stop.set()
+
+def plan(artistlinks,**kwargs):
+    '''
+    Dry run of artist links, nothing is downloaded or removed
+    kwargs          - update / update_all / reconcile, plan_sizes (HEAD requests for sizes), workers
+    Returns [{site, artist, mode, count, sized, bytes, postIDs, pruned}] in artistlinks order
+    '''
+    options = {
+        'verbose': False,
+        **kwargs,
+        'interactive': False,
+        'progress': False,
+        'plan': True,
+    }
+    plans = []
+    for link in artistlinks:
+        site, linkType = getLinkType(link)
+        if linkType != 'artist':
+            raise WeebException(f'Not an artist link: {link}')
+        d = downloaders[site](**options)
+        try:
+            d.download_artist(link)
+        finally:
+            d.close()
+        plans.append(d.planned)
+    return plans
@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+
+from pathlib import Path
+
+from ..utils import sanitize
+
+
+class Checkpoint:
+    '''
+    Run state of an artist download, lets --resume pick up where a run died
+
+    <site>_<artist>.json - crawl state, rewritten after every page
+    <site>_<artist>.log  - finished pics, appended as they complete
+    '''
+
+    folder = Path.home() / '.weebtools' / 'checkpoints'
+
+    def __init__(self,site,artist,artistlink):
+        name = sanitize(f'{site}_{artist}')
+        self.stateFile = self.folder / f'{name}.json'
+        self.logFile = self.folder / f'{name}.log'
+        self.lock = threading.Lock()
+
+        self.data = {
+            'artistlink': artistlink,
+            'update': False,
+            'update_all': False,
+            'reconcile': False,
+            'picList': [],
+            'page': 0,
+            'queue': None,
+        }
+        self.completed = set()
+        self.failed = set()
+
+    def load(self):
+        ''' Returns False if there's nothing to resume '''
+        if not self.stateFile.is_file():
+            return False
+        self.data = json.loads(self.stateFile.read_text())
+
+        if self.logFile.is_file():
+            for line in self.logFile.read_text().splitlines():
+                state, _, piclink = line.partition('\t')
+                if state == 'ok':
+                    self.completed.add(piclink)
+                    self.failed.discard(piclink)
+                elif state == 'fail':
+                    self.failed.add(piclink)
+        return True
+
+    def crawled(self,picList,page,update=False,update_all=False,reconcile=False):
+        self.data.update({
+            'update': bool(update),
+            'update_all': bool(update_all),
+            'reconcile': bool(reconcile),
+            'picList': picList,
+            'page': page,
+        })
+        self._save()
+
+    def queued(self,piclinks):
+        self.data['queue'] = piclinks
+        self._save()
+
+    def pending(self):
+        return [ x for x in self.data['queue'] if x not in self.completed ]
+
+    def record(self,piclink,ok):
+        with self.lock:
+            (self.completed if ok else self.failed).add(piclink)
+            with open(self.logFile,'a') as f:
+                f.write(f'{"ok" if ok else "fail"}\t{piclink}\n')
+
+    def remove(self):
+        for f in (self.stateFile,self.logFile):
+            f.unlink(missing_ok=True)
+
+    def _save(self):
+        self.folder.mkdir(parents=True,exist_ok=True)
+        tmp = self.stateFile.with_name(self.stateFile.name + '.tmp')
+        tmp.write_text(json.dumps(self.data,indent=4))
+        os.replace(tmp,self.stateFile)
@@ -0,0 +1,89 @@
+import datetime
+import json
+import os
+import threading
+
+from pathlib import Path
+
+from ..utils import fileLock
+from ..weebException import WeebException
+
+
+class FailLog:
+    '''
+    Structured failures, kept across runs until the pic downloads fine
+    {piclink: {site, error, status, message, attempts, checksumFails, permanent, lastAttempt}}
+    '''
+
+    # http status that won't get better by retrying
+    permanentStatus = {404, 410}
+    # md5 / file size mismatches allowed before giving up on a pic
+    maxChecksumFails = 3
+
+    def __init__(self,failFile):
+        self.failFile = Path(failFile)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self._reload()
+
+    def _reload(self):
+        # other processes (job queue workers) share the fail file
+        if self.failFile.is_file():
+            self.entries = json.loads(self.failFile.read_text())
+
+    @staticmethod
+    def classify(e):
+        ''' Returns error class, http status (or None) '''
+        msg = str(e)
+        if 'checksum' in msg or 'size mismatch' in msg:
+            return 'checksum', None
+        if status := getattr(e,'status',None):
+            return 'http', status
+        if msg.startswith('Invalid link'):
+            return 'invalid', None
+        if not isinstance(e,WeebException):
+            # requests ConnectionError / Timeout / ...
+            return type(e).__name__, None
+        return 'other', None
+
+    def record(self,piclink,site,e):
+        error, status = self.classify(e)
+        with self.lock, fileLock(self.failFile):
+            self._reload()
+            entry = self.entries.setdefault(piclink,{
+                'site': site,
+                'attempts': 0,
+                'checksumFails': 0,
+            })
+            entry['attempts'] += 1
+            if error == 'checksum':
+                entry['checksumFails'] += 1
+            entry.update({
+                'error': error,
+                'status': status,
+                'message': str(e),
+                'lastAttempt': datetime.datetime.now().strftime('%m-%d-%Y %I:%M:%S %p'),
+            })
+            entry['permanent'] = (status in self.permanentStatus
+                or error == 'invalid'
+                or entry['checksumFails'] >= self.maxChecksumFails)
+            self._save()
+
+    def success(self,piclink):
+        if piclink not in self.entries:
+            return
+        with self.lock, fileLock(self.failFile):
+            self._reload()
+            if self.entries.pop(piclink,None):
+                self._save()
+
+    def retryable(self,site=None):
+        with self.lock:
+            return [ k for k,v in self.entries.items()
+                if not v['permanent'] and site in (None,v['site']) ]
+
+    def _save(self):
+        self.failFile.parent.mkdir(parents=True,exist_ok=True)
+        tmp = self.failFile.with_name(self.failFile.name + '.tmp')
+        tmp.write_text(json.dumps(self.entries,indent=4))
+        os.replace(tmp,self.failFile)
@@ -0,0 +1,72 @@
+import os
+
+from ..weebException import WeebException
+
+
+class AtomicWriter:
+    '''
+    Writes a pic to <name>.part, only renamed to the real name on commit()
+    so a crash / failed check never leaves a truncated pic behind
+
+    size    - final size if known, preallocated up front
+              bytes written to tmp by others (byte ranges) are added to written
+    fsync   - never  : leave it to the OS
+              file   : fsync the pic before the rename
+              always : also fsync the dir after the rename
+    '''
+
+    fsyncPolicies = ('never','file','always')
+    bufferSize = 2**20
+
+    def __init__(self,picture,size=None,fsync='never'):
+        if fsync not in self.fsyncPolicies:
+            raise WeebException(f'fsync must be one of {self.fsyncPolicies}')
+        self.picture = picture
+        self.tmp = picture.with_name(picture.name + '.part')
+        self.size = size
+        self.fsync = fsync
+        self.written = 0
+        self._f = None
+        self._committed = False
+
+    def __enter__(self):
+        self._f = open(self.tmp,'wb',buffering=self.bufferSize)
+        if self.size:
+            try:
+                os.posix_fallocate(self._f.fileno(),0,self.size)
+            except (AttributeError,OSError):
+                # windows / filesystems without fallocate
+                self._f.truncate(self.size)
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+        if not self._committed:
+            self.tmp.unlink(missing_ok=True)
+
+    def write(self,chunk):
+        self._f.write(chunk)
+        self.written += len(chunk)
+
+    def close(self):
+        ''' Flushes the sequential writes, tmp file can then be read / written by others '''
+        if self._f and not self._f.closed:
+            self._f.flush()
+            if self.fsync != 'never':
+                os.fsync(self._f.fileno())
+            self._f.close()
+
+    def commit(self):
+        self.close()
+        # preallocated file, a short / empty body would be zero padded
+        if self.size is not None and self.written != self.size:
+            raise WeebException(f'{self.picture} File size mismatch {self.written} != {self.size}')
+        os.replace(self.tmp,self.picture)
+        self._committed = True
+
+        if self.fsync == 'always' and hasattr(os,'O_DIRECTORY'):
+            fd = os.open(self.picture.parent,os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
@@ -1,13 +1,23 @@
 import concurrent.futures
+import contextlib
 import datetime
 import itertools
 import re
+import statistics
+import requests
 import threading
+import time
 
 from pathlib import Path
 
+from .checkpoint import Checkpoint
+from .failures import FailLog
+from .localIndex import LocalIndex
+from .progress import Progress
+from .scheduler import policies, RateLimiter
+from .tagIndex import TagIndex
 from ..utils import (
-    getJsonData, writeJsonData, makeDirs,
+    askQuestion, fileLock, getJsonData, writeJsonData, makeDirs, removeDirs, SessionPool,
 )
 from ..weebException import WeebException
 
@@ -36,7 +46,11 @@ class ImageDownloader:
         },
     }
 
-    failFile = Path.home() / '.weebtools' / 'fail.txt'
+    # set by subclasses, one of valid keys
+    site = None
+
+    imgFolder = Path.home() / 'Downloads' / 'images'
+    failFile = Path.home() / '.weebtools' / 'fail.json'
 
     @classmethod
     def checkValid(cls,link,site,linkType):
@@ -51,29 +65,96 @@ class ImageDownloader:
 
     def __init__(self,**kwargs):
         ''' Parent downloader class, common things go here '''
-        self.imgFolder = Path.home() / 'Downloads' / 'images'
         self.imgFolder.mkdir(parents=True,exist_ok=True)
 
         self.lock = threading.Lock()
+        # per worker thread state (session, pics of the current piclink)
+        self._local = threading.local()
 
         self.picList = []
+        self.localIndexes = {}
         self.summary = {
             'artists': [],
             'success': [],
             'fail': [],
             'png': [],
             'jpg': [],
+            # secs from download start until each piclink completed
+            'latency': [],
         }
 
         self.update = kwargs.get('update')
         self.update_all = kwargs.get('update_all')
-
-        if self.update and self.update_all:
-            raise WeebException('--update / --update_all are mutually exclusive')
+        # existing artist dir synced with the crawl instead of removed
+        self.reconcile = kwargs.get('reconcile')
+        # post IDs removed by reconcile
+        self.pruned = []
+
+        # False for anything that can't ask the user (retries, library use...)
+        self.interactive = kwargs.get('interactive',True)
+        self.verbose = kwargs.get('verbose',True)
+        # on_result(piclink,pictures,error) called as each piclink completes
+        self.onResult = kwargs.get('on_result')
+        # threading.Event, once set no more downloads are submitted (in flight ones finish)
+        self.stopEvent = kwargs.get('stop_event')
+        self.failLog = FailLog(self.failFile)
+
+        # download pool size / max downloads in flight
+        self.workers = kwargs.get('workers') or 4
+        self.window = kwargs.get('window') or self.workers * 2
+        # both can be shared with other downloaders, executor is never shut down here
+        self.executor = kwargs.get('executor')
+        self.sessionPool = kwargs.get('session_pool') or SessionPool()
+
+        # files at least this big (bytes) are fetched as byte ranges in parallel
+        self.segmentThreshold = kwargs.get('segment_threshold') or 16 * 2**20
+        self.segments = kwargs.get('segments') or 4
+
+        # order piclinks get submitted in, one of scheduler.policies
+        self.schedule = kwargs.get('schedule') or 'crawl'
+        if self.schedule not in policies:
+            raise WeebException(f'Unknown schedule {self.schedule}, one of {", ".join(policies)}')
+        # {piclink: bytes} known before download, filled while crawling (sites that list sizes)
+        self.sizeHints = {}
+        # {piclink: md5} of the original file, same sites, reconcile compares it when sizes match
+        self.md5Hints = {}
+        # global bandwidth cap (bytes/s) over every download thread, can be shared
+        self.rateLimiter = kwargs.get('rate_limiter') or (
+            RateLimiter(kwargs['max_rate']) if kwargs.get('max_rate') else None)
+
+        # AtomicWriter fsync policy
+        self.fsync = kwargs.get('fsync') or 'never'
+
+        # live progress surface, only used for multithread downloads
+        self.showProgress = kwargs.get('progress',True)
+        self.statsFile = kwargs.get('stats_file')
+        self.progress = None
+
+        # artist runs only
+        self.resume = kwargs.get('resume')
+        # dry run, crawl and diff with the catalog only, result in self.planned
+        self.plan = kwargs.get('plan')
+        self.planSizes = kwargs.get('plan_sizes')
+        self.planned = None
+        self.checkpoint = None
+        # JobQueue, crawled pics are queued for every worker instead of downloaded here
+        self.jobQueue = kwargs.get('job_queue')
+
+        # global tag / artist / rating index of every pic, share one between downloaders
+        # with tag_index, otherwise it's opened from tag_db and closed by close()
+        self._ownTagIndex = not kwargs.get('tag_index')
+        self.tagIndex = kwargs.get('tag_index') or TagIndex(kwargs.get('tag_db'))
+
+        if sum(map(bool,(self.update,self.update_all,self.reconcile))) > 1:
+            raise WeebException('--update / --update_all / --reconcile are mutually exclusive')
 
     def updateInfoFile(self,sourceDir,infoData):
         infoFile = sourceDir / 'info.json'
+        # other weebtools processes (job queue workers) can write the same artist
+        with fileLock(infoFile):
+            self._updateInfoFile(infoFile,infoData)
 
+    def _updateInfoFile(self,infoFile,infoData):
         now = datetime.datetime.now().strftime('%m-%d-%Y %I:%M:%S %p')
         if infoFile.is_file():
             j = getJsonData(infoFile)
@@ -106,6 +187,35 @@ class ImageDownloader:
 
         writeJsonData(j,infoFile)
 
+    def removeFromInfoFile(self,sourceDir,piclinks):
+        ''' Drops piclinks of this site from info.json (piclinks / explicit) '''
+        infoFile = sourceDir / 'info.json'
+        with self.lock, fileLock(infoFile):
+            if not infoFile.is_file():
+                return
+            j = getJsonData(infoFile)
+            for key in ('piclinks','explicit'):
+                j[key][self.site] = [ x for x in j[key][self.site] if x not in piclinks ]
+            writeJsonData(j,infoFile)
+
+    def addPicture(self,sourceDir,infoData,artist,picture,page=0):
+        '''
+        Records a downloaded (or already on disk) pic in info.json, tag index and summary
+        infoData also carries postID / tags / rating for the tag index
+        '''
+        picData = {
+            'artist': artist,
+            'picture': picture,
+            'explicit': infoData['explicit'],
+        }
+        with self.lock:
+            self.updateInfoFile(sourceDir,infoData)
+            self.summary[picture.suffix[1:]].append(picData)
+        self.tagIndex.add(self.site,infoData['postID'],page,artist,
+            infoData['rating'],infoData['tags'],picture,infoData['piclink'])
+        if (pictures := getattr(self._local,'pictures',None)) is not None:
+            pictures.append(picData)
+
     def printSummary(self,state='single'):
 
         picTypes = [
@@ -113,7 +223,7 @@ class ImageDownloader:
             'jpg',
         ]
         picData = [ p for x in picTypes for p in self.summary[x] ]
-        if not picData:
+        if not picData and state != 'retry':
             print('NO SUMMARY')
             return
 
@@ -129,6 +239,14 @@ class ImageDownloader:
                 print(f'Total: {len(picData)} pictures')
             print(f'Stored in: {pd["picture"].parent}')
 
+        elif state == 'retry':
+            print(f'Retried: {len(self.summary["success"]) + len(self.summary["fail"])}')
+            print(f'Success: {len(self.summary["success"])}')
+            if self.summary['fail']:
+                print(f'Fail: {len(self.summary["fail"])}')
+                print(f'View {self.failFile} for failures')
+            self.printLatency()
+
         elif state == 'artist':
             print(f'Artist: {self.summary["artists"][0]}')
             print(f'Total pics: {len(picData)}')
@@ -139,31 +257,334 @@ class ImageDownloader:
                 print(f'Success: {len(self.summary["success"])}')
                 print(f'Fail: {len(self.summary["fail"])}')
                 print(f'View {self.failFile} for failures')
+            self.printLatency()
 
         print('='*50)
 
-    def _download(self,piclinks):
-        ''' Multithread download '''
-        print(f'Downloading {len(piclinks)} pics')
-        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as ex:
-            futures = {ex.submit(self.download_single,pl):pl for pl in piclinks}
+    def printLatency(self):
+        ''' Time to complete pics, mean is what the schedule policy lowers '''
+        if not (latency := self.summary['latency']):
+            return
+        print(f'Schedule: {self.schedule}')
+        print(f'Latency: mean {statistics.mean(latency):.1f}s'
+            f', median {statistics.median(latency):.1f}s'
+            f', last {max(latency):.1f}s')
+
+    def download_many(self,piclinks):
+        '''
+        Multithread download of pic links (single links of any artist), no checkpoint or queue
+        Keeps at most self.window downloads in flight and records
+        each result as soon as it completes, self.schedule picks what goes next
+        '''
+        self.log(f'Downloading {len(piclinks)} pics')
+        if self.showProgress or self.statsFile:
+            self.progress = Progress(len(piclinks),
+                statsFile=self.statsFile,
+                show=self.showProgress)
+            self.progress.start()
+
+        scheduler = policies[self.schedule](piclinks,
+            sizes=self.sizeHints,
+            postIDs={ x: self.getPostID(x) for x in piclinks },
+            slots=self.workers)
+        self._start = time.monotonic()
+        inFlight = {}
+
+        def _submit(ex,n):
+            for _ in range(n):
+                if self.stopEvent and self.stopEvent.is_set():
+                    break
+                if (pl := scheduler.next()) is None:
+                    break
+                inFlight[ex.submit(self._worker,pl)] = pl
+            self._setInFlight(len(inFlight))
 
-        for f in concurrent.futures.as_completed(futures):
+        try:
+            with (contextlib.nullcontext(self.executor) if self.executor
+                    else concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)) as ex:
+                _submit(ex,self.window)
+                while inFlight:
+                    done, _ = concurrent.futures.wait(inFlight,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in done:
+                        pl = inFlight.pop(f)
+                        scheduler.done(pl)
+                        self._recordResult(pl,f)
+                    # held back pics (lanes) can go once a slot frees up
+                    _submit(ex,self.window - len(inFlight))
+        finally:
+            if self.progress:
+                self.progress.stop()
+                self.progress = None
+            self.saveLocalIndexes()
+
+    def _worker(self,piclink):
+        ''' Returns the pics (addPicture data) of piclink '''
+        if self.progress:
+            self.progress.workerStart(piclink)
+        self._local.session = self.sessionPool.get()
+        self._local.pictures = []
+        try:
+            self.download_single(piclink)
+            return self._local.pictures
+        finally:
+            self.sessionPool.put(self._local.session)
+            self._local.session = None
+            self._local.pictures = None
+            if self.progress:
+                self.progress.workerDone()
+
+    def getSession(self):
+        ''' Pooled session of the current worker, new one for one time downloads '''
+        return getattr(self._local,'session',None) or requests.Session()
+
+    def log(self,*args,**kwargs):
+        if self.verbose:
+            print(*args,flush=True,**kwargs)
+
+    def _setInFlight(self,n):
+        if self.progress:
+            self.progress.inFlight = n
+
+    def _status(self,msg):
+        ''' Per pic status, only printed when no progress surface is shown (stats file only runs too) '''
+        if not (self.progress and self.progress.show):
+            with self.lock:
+                self.log(msg)
+
+    def _addBytes(self,n):
+        ''' Called after every chunk written, throttles the calling thread when capped '''
+        if self.progress:
+            self.progress.addBytes(n)
+        if self.rateLimiter:
+            self.rateLimiter.consume(n)
+
+    def getPostID(self,piclink):
+        ''' Post ID of a single link of this site, 0 if it isn't one '''
+        for r in self.valid.get(self.site,{}).get('single',[]):
+            if m := re.match(r,piclink):
+                return int(m.group(1))
+        return 0
+
+    def _recordResult(self,piclink,future):
+        pictures, error = [], None
+        try:
+            pictures = future.result()
+            self.summary['success'].append(piclink)
+            self.failLog.success(piclink)
+            ok = True
+        except Exception as e:
+            self.summary['fail'].append(f'{piclink} {e}')
+            self.failLog.record(piclink,self.site,e)
+            error = e
+            ok = False
+        self.summary['latency'].append(time.monotonic() - self._start)
+
+        if self.onResult:
+            self.onResult(piclink,pictures,error)
+
+        if self.progress:
+            self.progress.finish(ok)
+        if self.checkpoint:
+            self.checkpoint.record(piclink,ok)
+
+    def startCheckpoint(self,site,artist,artistlink):
+        '''
+        Returns True if a previous run of this artist is being resumed,
+        update flags are restored from the checkpoint in that case
+        '''
+        if self.plan:
+            # a dry run doesn't touch the checkpoint of a real run
+            return False
+        self.checkpoint = Checkpoint(site,artist,artistlink)
+        if self.resume and self.checkpoint.load():
+            d = self.checkpoint.data
+            self.update, self.update_all = d['update'], d['update_all']
+            self.reconcile = d.get('reconcile',False)
+            self.picList = d['picList']
+            self.log(f'Resuming from checkpoint {self.checkpoint.stateFile} (page {d["page"]})')
+            return True
+
+        if self.resume:
+            self.log(f'No checkpoint found for {artist}, starting over')
+        self.checkpoint.remove()
+        return False
+
+    def saveCrawl(self,page):
+        if self.checkpoint:
+            self.checkpoint.crawled(self.picList,page,self.update,self.update_all,self.reconcile)
+
+    def download_queue(self,piclinks=None):
+        '''
+        Artist run download, keeps the checkpoint until every pic made it
+        piclinks=None continues the queue of a resumed checkpoint
+        '''
+        if self.plan:
+            self.planned = self.makePlan(piclinks)
+            return
+
+        if self.jobQueue:
+            added = self.jobQueue.add(piclinks,self.site,'single')
+            self.log(f'Queued {added} pics in {self.jobQueue.dbFile}')
+            if self.checkpoint:
+                self.checkpoint.remove()
+            return
+
+        if not self.checkpoint:
+            self.download_many(piclinks)
+            return
+
+        if piclinks is not None:
+            self.checkpoint.queued(piclinks)
+        pending = self.checkpoint.pending()
+        if len(pending) < len(self.checkpoint.data['queue']):
+            self.log(f'Skipping {len(self.checkpoint.data["queue"]) - len(pending)} pics done in previous run')
+
+        self.download_many(pending)
+
+        if not self.summary['fail']:
+            self.checkpoint.remove()
+
+    def makePlan(self,piclinks):
+        '''
+        What an artist run would download, json friendly
+        bytes only counts the sized pics (listing sizes, or HEAD requests with plan_sizes)
+        '''
+        sizes = self.getSizes(piclinks)
+        return {
+            'site': self.site,
+            'artist': self.summary['artists'][0],
+            'mode': ('update' if self.update else 'update_all' if self.update_all
+                else 'reconcile' if self.reconcile else 'full'),
+            'count': len(piclinks),
+            'sized': len(sizes),
+            'bytes': sum(sizes.values()),
+            'postIDs': [ self.getPostID(x) for x in piclinks ],
+            'pruned': self.pruned,
+        }
+
+    def getSizes(self,piclinks):
+        ''' {piclink: bytes} known without downloading, subclasses can ask the server '''
+        return { x: self.sizeHints[x] for x in piclinks if x in self.sizeHints }
+
+    def retry_failed(self,rounds=3,backoff=2):
+        '''
+        Re-runs failed pics of this site from the fail file
+        Skips permanent errors, waits backoff*2^n secs between rounds
+        '''
+        for n in range(rounds):
+            if not (todo := self.failLog.retryable(self.site)):
+                break
+            if n:
+                wait = backoff * 2**(n-1)
+                self.log(f'Retrying {len(todo)} failures in {wait}s')
+                time.sleep(wait)
+
+            self.summary['fail'] = []
+            self.download_many(todo)
+
+        permanent = [ k for k,v in self.failLog.entries.items()
+            if v['permanent'] and v['site'] == self.site ]
+        if permanent:
+            self.log(f'Skipped {len(permanent)} permanent failures ({self.site})')
+
+    def confirmRemoveArtist(self,artist,artistDir):
+        ''' Artist dir exists and no update flag given, start over from scratch '''
+        if self.plan:
+            return
+        if not self.interactive:
+            raise WeebException(f'"{artist}" already exists, use update / update_all')
+        if askQuestion(f'"{artist}" already exists, continue?')=='n':
+            raise WeebException('User cancelled download')
+        removeDirs(artistDir)
+
+    def reconcileArtist(self,artist,crawled):
+        '''
+        Syncs an existing artist dir with a complete crawl instead of starting over
+        Returns the crawled piclinks to download: missing in info.json or on disk,
+        with a local size different from the listing size (truncated / replaced),
+        or the same size but a different md5 (corrupted) when the listing has one
+        Posts missing from the crawl are only pruned from disk, info.json, index.json
+        and the tag index once the site confirms they're gone (isGone),
+        a partial crawl or a retagged post never deletes anything
+        '''
+        artistDir = self.imgFolder / artist
+        if not artistDir.is_dir():
+            return crawled
+        if not crawled:
+            raise WeebException(f'Nothing crawled for "{artist}", not reconciling')
+
+        sourceDir = artistDir / 'source'
+        catalog = set(getJsonData(sourceDir / 'info.json').get('piclinks',{}).get(self.site,[]))
+        index = self.getLocalIndex(artist)
+        local = index.posts(self.site)
+
+        todo = []
+        for piclink in crawled:
+            pics = local.get(self.getPostID(piclink))
+            size = self.sizeHints.get(piclink)
+            md5 = self.md5Hints.get(piclink)
+            if piclink not in catalog or not pics:
+                todo.append(piclink)
+            elif size and md5:
+                # hashes the local pic once, index.json keeps the md5
+                if not index.match(self.site,self.getPostID(piclink),size,md5):
+                    todo.append(piclink)
+            elif size and all(entry['size'] != size for _,entry in pics):
+                todo.append(piclink)
+
+        crawledIDs = { self.getPostID(x) for x in crawled }
+        prune = [ x for x in catalog if self.getPostID(x) not in crawledIDs ]
+        missingIDs = { self.getPostID(x) for x in prune } | (local.keys() - crawledIDs)
+        pruneIDs = self.confirmGone(missingIDs)
+        prune = [ x for x in prune if self.getPostID(x) in pruneIDs ]
+        self.log(f'Reconcile: {len(crawled) - len(todo)} pics in sync, '
+            f'{len(todo)} to download, {len(pruneIDs)} removed from the site')
+        if kept := len(missingIDs) - len(pruneIDs):
+            self.log(f'Reconcile: {kept} posts not crawled but still on the site, kept')
+
+        self.pruned = sorted(pruneIDs,reverse=True)
+        if self.plan:
+            return todo
+
+        for postID in pruneIDs:
+            for pic,_ in local.get(postID,[]):
+                pic.unlink(missing_ok=True)
+                index.remove(pic)
+            self.tagIndex.remove(self.site,postID)
+        if prune:
+            self.removeFromInfoFile(sourceDir,set(prune))
+        index.save()
+        return todo
+
+    def confirmGone(self,postIDs):
+        ''' postIDs the site confirms are deleted, any error keeps the post '''
+        def _gone(postID):
+            s = self.sessionPool.get()
             try:
-                f.result()
-                self.summary['success'].append(futures[f])
+                return self.isGone(s,postID)
             except Exception as e:
-                self.summary['fail'].append(f'{futures[f]} {e}')
+                self.log(f'Could not check post {postID}, kept: {e}')
+                return False
+            finally:
+                self.sessionPool.put(s)
+
+        postIDs = sorted(postIDs)
+        if not postIDs:
+            return set()
+        self.log(f'Checking {len(postIDs)} posts missing from the crawl')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as ex:
+            return { x for x,gone in zip(postIDs,ex.map(_gone,postIDs)) if gone }
 
-        if self.summary['fail']:
-            self.failFile.parent.mkdir(exist_ok=True)
-            self.failFile.write_text('\n'.join(self.summary['fail']))
+    def isGone(self,s,postID):
+        ''' True only when the site says the post doesn't exist anymore, set by subclasses '''
+        raise NotImplementedError
 
     def getLazyUpdates(self,listAll,listCurrent,init=False):
         updateList = list(itertools.takewhile(
                 lambda x: x not in listCurrent,listAll))
 
-        if init and not updateList:
+        if init and not updateList and not self.plan:
             raise WeebException('Everything up to date')
 
         return updateList
@@ -171,6 +592,54 @@ class ImageDownloader:
     def getAllUpdates(self,listAll,listCurrent):
         return [ x for x in listAll if x not in listCurrent ]
 
+    def getLocalIndex(self,artist):
+        ''' One index per artist dir per run, built on first use '''
+        with self.lock:
+            if artist not in self.localIndexes:
+                self.localIndexes[artist] = LocalIndex(self.imgFolder / artist)
+            return self.localIndexes[artist]
+
+    def saveLocalIndexes(self):
+        for index in self.localIndexes.values():
+            index.save()
+
+    def close(self):
+        if self._ownTagIndex:
+            self.tagIndex.close()
+
+    def downloadRanges(self,session,url,picture,size,headers=None):
+        '''
+        Fetches url as self.segments byte ranges concurrently,
+        each range written in place into picture, already preallocated to size
+        (AtomicWriter tmp file), caller still verifies the result
+        Returns bytes written
+        '''
+        step = -(-size // self.segments)
+        ranges = [ (x,min(x+step,size)-1) for x in range(0,size,step) ]
+
+        def _fetch(start,end):
+            # sessions aren't thread safe, a pooled one per range (kept alive connections)
+            # with the caller's headers / cookies passed per request
+            rs = self.sessionPool.get()
+            try:
+                h = dict(session.headers, **(headers or {}), Range=f'bytes={start}-{end}')
+                with rs.get(url,headers=h,cookies=session.cookies,stream=True) as r:
+                    if r.status_code != 206:
+                        raise WeebException(f'Range request error: {r.status_code}',status=r.status_code)
+                    with open(picture,'r+b') as f:
+                        f.seek(start)
+                        for chunk in r.iter_content(chunk_size=2**16):
+                            f.write(chunk)
+                            self._addBytes(len(chunk))
+                        if f.tell() != end + 1:
+                            raise WeebException(f'Range {start}-{end} incomplete')
+            finally:
+                self.sessionPool.put(rs)
+            return end + 1 - start
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as ex:
+            return sum(f.result() for f in [ ex.submit(_fetch,*x) for x in ranges ])
+
     def setupArtistDir(self,artist):
         artistDir   = self.imgFolder / artist
         pngDir      = artistDir / 'png'
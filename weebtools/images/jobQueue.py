@@ -0,0 +1,219 @@
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+
+from .api import downloaders
+from .tagIndex import TagIndex
+from ..weebException import WeebException
+
+
+class JobQueue:
+    '''
+    sqlite job queue shared by weebtools processes on one box
+    dbFile has to be on a local disk, sqlite locking isn't reliable on NFS / SMB,
+    BEGIN IMMEDIATE wouldn't stop two boxes from leasing the same job
+
+    artist jobs get crawled, their pics are added back as single jobs
+    so every worker shares the downloads of a big artist
+    Jobs are leased for leaseTime secs, a heartbeat keeps the lease while working,
+    leases of dead workers expire and the job goes back to pending
+    '''
+
+    defaultFile = Path.home() / '.weebtools' / 'queue.db'
+
+    leaseTime = 120
+    maxAttempts = 3
+
+    def __init__(self,dbFile=None,owner=None):
+        self.dbFile = Path(dbFile or self.defaultFile)
+        self.dbFile.parent.mkdir(parents=True,exist_ok=True)
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+
+        self._stopEvent = threading.Event()
+        self._heartbeat = None
+
+        with self._connect() as db:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    link        TEXT PRIMARY KEY,
+                    site        TEXT NOT NULL,
+                    kind        TEXT NOT NULL,
+                    options     TEXT NOT NULL DEFAULT '{}',
+                    state       TEXT NOT NULL DEFAULT 'pending',
+                    owner       TEXT,
+                    leaseUntil  REAL,
+                    attempts    INTEGER NOT NULL DEFAULT 0,
+                    error       TEXT,
+                    updated     REAL
+                )''')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state,kind)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # one connection per call, safe to use from the heartbeat thread
+        db = sqlite3.connect(self.dbFile,timeout=60,isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._connect() as db:
+            # write lock up front, no two workers can lease the same job
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def add(self,links,site,kind,options=None):
+        '''
+        Pending / leased links are left alone, done / failed ones go back to pending
+        with the new options (daily updates, reconcile downloads), returns how many were (re)queued
+        '''
+        with self._transaction() as db:
+            cur = db.executemany('''
+                INSERT INTO jobs (link,site,kind,options,updated) VALUES (?,?,?,?,?)
+                ON CONFLICT(link) DO UPDATE SET
+                    site = excluded.site, kind = excluded.kind, options = excluded.options,
+                    state = 'pending', owner = NULL, leaseUntil = NULL, attempts = 0,
+                    error = NULL, updated = excluded.updated
+                WHERE state IN ('done','failed')''',
+                [ (x,site,kind,json.dumps(options or {}),time.time()) for x in links ])
+            return cur.rowcount
+
+    def lease(self,n,kind):
+        '''
+        Returns up to n [(link,site,options)], pending or with an expired lease
+        Expired leases that used up maxAttempts (a job that kills its worker) are failed instead
+        '''
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('''
+                UPDATE jobs SET state = 'failed', error = 'Lease expired too many times', leaseUntil = NULL, updated = ?
+                WHERE state = 'leased' AND leaseUntil < ? AND attempts >= ?''',
+                (now,now,self.maxAttempts))
+            rows = db.execute('''
+                SELECT link,site,options FROM jobs
+                WHERE (state = 'pending' OR (state = 'leased' AND leaseUntil < ? AND attempts < ?))
+                AND kind = ?
+                ORDER BY updated
+                LIMIT ?''',(now,self.maxAttempts,kind,n)).fetchall()
+            db.executemany('''
+                UPDATE jobs SET state = 'leased', owner = ?, leaseUntil = ?, attempts = attempts + 1, updated = ?
+                WHERE link = ?''',
+                [ (self.owner,now+self.leaseTime,now,x[0]) for x in rows ])
+        return [ (link,site,json.loads(options)) for link,site,options in rows ]
+
+    def complete(self,link):
+        self._finish(link,'done',None)
+
+    def fail(self,link,error):
+        ''' Back to pending until maxAttempts '''
+        self._finish(link,'failed',str(error))
+
+    def _finish(self,link,state,error):
+        with self._transaction() as db:
+            if state == 'failed':
+                state = db.execute('''
+                    SELECT CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END
+                    FROM jobs WHERE link = ?''',(self.maxAttempts,link)).fetchone()[0]
+            # a worker that lost its lease doesn't get to overwrite the new owner
+            db.execute('''
+                UPDATE jobs SET state = ?, error = ?, leaseUntil = NULL, updated = ?
+                WHERE link = ? AND owner = ?''',
+                (state,error,time.time(),link,self.owner))
+
+    def status(self):
+        with self._connect() as db:
+            return dict(db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def startHeartbeat(self):
+        self._stopEvent.clear()
+        self._heartbeat = threading.Thread(target=self._beat,name='weebtools-heartbeat',daemon=True)
+        self._heartbeat.start()
+
+    def stopHeartbeat(self):
+        self._stopEvent.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def _beat(self):
+        while not self._stopEvent.wait(self.leaseTime / 3):
+            try:
+                with self._transaction() as db:
+                    db.execute('''
+                        UPDATE jobs SET leaseUntil = ?
+                        WHERE owner = ? AND state = 'leased' ''',
+                        (time.time()+self.leaseTime,self.owner))
+            except sqlite3.Error as e:
+                # locked for too long, leases still have 2 beats left before expiring
+                print(f'Queue heartbeat failed, retrying: {e}',flush=True)
+
+    def work(self,poll=0,**options):
+        '''
+        Leases and runs jobs until the queue is empty,
+        or forever checking for new jobs every poll secs
+        options go to the downloaders (workers, fsync, tag_db...)
+        '''
+        tagIndex = TagIndex(options.get('tag_db'))
+        options = {
+            **options,
+            'interactive': False,
+            'job_queue': self,
+            'tag_index': tagIndex,
+        }
+        singles = {}
+
+        def _onResult(piclink,pictures,error):
+            if error:
+                self.fail(piclink,error)
+            else:
+                self.complete(piclink)
+
+        self.startHeartbeat()
+        try:
+            while True:
+                # pics first, crawl another artist only when there's nothing to download
+                if jobs := self.lease((options.get('workers') or 4) * 4,'single'):
+                    for site in downloaders:
+                        if links := [ x[0] for x in jobs if x[1] == site ]:
+                            if site not in singles:
+                                singles[site] = downloaders[site](**options,on_result=_onResult)
+                            singles[site].download_many(links)
+
+                elif jobs := self.lease(1,'artist'):
+                    link, site, jobOptions = jobs[0]
+                    d = downloaders[site](**options,**jobOptions)
+                    try:
+                        d.download_artist(link)
+                        self.complete(link)
+                    except WeebException as e:
+                        if str(e) == 'Everything up to date':
+                            self.complete(link)
+                        else:
+                            self.fail(link,e)
+                    except Exception as e:
+                        self.fail(link,e)
+                    finally:
+                        d.close()
+
+                elif poll:
+                    time.sleep(poll)
+                else:
+                    break
+        finally:
+            self.stopHeartbeat()
+            for d in singles.values():
+                d.close()
+            tagIndex.close()
@@ -0,0 +1,136 @@
+import json
+import os
+import re
+import threading
+import time
+
+from ..utils import getHash
+
+
+class LocalIndex:
+    '''
+    Pics already on disk for an artist dir, cached in source/index.json
+    {"png/<name>": {site, postID, page, size, mtime, md5}}
+
+    Post ID comes from the file name
+    yande - yande.re <id> <tags>.<ext>
+    pixiv - <id>_<title>_p<page>.<ext>
+    md5 is only computed when a size matches, then cached until the file changes
+    '''
+
+    patterns = {
+        'yande': re.compile(r'^yande\.re (\d+)\b'),
+        'pixiv': re.compile(r'^(\d+)_.*_p(\d+)\.\w+$'),
+    }
+
+    # secs between index.json writes
+    saveInterval = 2
+    # .part files untouched this long are leftovers of a killed run
+    partMaxAge = 3600
+
+    def __init__(self,artistDir):
+        self.artistDir = artistDir
+        self.indexFile = artistDir / 'source' / 'index.json'
+        self.lock = threading.Lock()
+        self._lastSave = 0
+        self._dirty = False
+
+        cached = {}
+        if self.indexFile.is_file():
+            try:
+                cached = json.loads(self.indexFile.read_text())
+            except ValueError:
+                pass
+
+        self.entries = {}
+        for d in ('png','jpg'):
+            if not (artistDir / d).is_dir():
+                continue
+            for pic in (artistDir / d).iterdir():
+                if pic.suffix == '.part':
+                    # AtomicWriter leftovers, recent ones may still be downloading
+                    try:
+                        if time.time() - pic.stat().st_mtime > self.partMaxAge:
+                            pic.unlink()
+                    except FileNotFoundError:
+                        # committed meanwhile
+                        pass
+                    continue
+                if pic.suffix != f'.{d}' or not pic.is_file():
+                    continue
+                key = f'{d}/{pic.name}'
+                st = pic.stat()
+                entry = cached.get(key)
+                if not entry or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+                    entry = self._parse(pic.name)
+                    if not entry:
+                        continue
+                    entry.update(size=st.st_size,mtime=st.st_mtime,md5=None)
+                self.entries[key] = entry
+
+        self._dirty = self.entries != cached
+
+    def _parse(self,name):
+        for site,com in self.patterns.items():
+            if m := com.match(name):
+                return {
+                    'site': site,
+                    'postID': int(m.group(1)),
+                    'page': int(m.group(2)) if com.groups > 1 else 0,
+                }
+
+    def find(self,site,postID,page=0):
+        with self.lock:
+            return [ (self.artistDir / k, v) for k,v in self.entries.items()
+                if v['site'] == site and v['postID'] == int(postID) and v['page'] == page ]
+
+    def match(self,site,postID,size,md5=None,page=0):
+        ''' Returns the local pic with the same size (and md5 if given), None otherwise '''
+        for pic,entry in self.find(site,postID,page):
+            if entry['size'] != size:
+                continue
+            if md5 is None:
+                return pic
+            if entry['md5'] is None:
+                entry['md5'] = getHash('md5',pic)
+                self._changed()
+            if entry['md5'] == md5:
+                return pic
+
+    def posts(self,site):
+        ''' {postID: [(pic, entry)]} of every pic of site '''
+        posts = {}
+        with self.lock:
+            for k,v in self.entries.items():
+                if v['site'] == site:
+                    posts.setdefault(v['postID'],[]).append((self.artistDir / k,v))
+        return posts
+
+    def remove(self,pic):
+        with self.lock:
+            self.entries.pop(f'{pic.parent.name}/{pic.name}',None)
+        self._changed()
+
+    def add(self,pic,md5=None):
+        if not (entry := self._parse(pic.name)):
+            return
+        st = pic.stat()
+        entry.update(size=st.st_size,mtime=st.st_mtime,md5=md5)
+        with self.lock:
+            self.entries[f'{pic.parent.name}/{pic.name}'] = entry
+        self._changed()
+
+    def _changed(self):
+        self._dirty = True
+        if time.monotonic() - self._lastSave >= self.saveInterval:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            if not self._dirty or not self.indexFile.parent.is_dir():
+                return
+            tmp = self.indexFile.with_name(self.indexFile.name + '.tmp')
+            tmp.write_text(json.dumps(self.entries,indent=4))
+            os.replace(tmp,self.indexFile)
+            self._dirty = False
+            self._lastSave = time.monotonic()
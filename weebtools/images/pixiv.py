@@ -1,3 +1,4 @@
+import concurrent.futures
 import json
 import re
 import requests
@@ -7,81 +8,184 @@ from bs4 import BeautifulSoup
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from .fileWriter import AtomicWriter
 from .imageDownloader import ImageDownloader
 from ..utils import (
     askQuestion, getSeleniumDriver, getJsonData,
-    getSS, getUserPass, removeDirs, sanitize,
+    getSS, getUserPass, sanitize,
 )
 from ..weebException import WeebException
 
 
 class Pixiv(ImageDownloader):
 
+    site = 'pixiv'
+
     def __init__(self,*args,**kwargs):
         super().__init__(*args,**kwargs)
 
         self.driver = None
 
+        # artist runs: illust metadata fetched in bulk, {picID: getIllust data}
+        self.metadata = {}
+        self.artistID = None
+        self.cookies = None
+        # extension of the last original found, artists mostly stick to one
+        self.lastExt = 'jpg'
+
     def download_single(self,piclink):
         ''' Can be worker or called explcitly for one time download '''
         picID = self.checkValid(piclink,'pixiv','single')
 
-        s = requests.Session()
-        r = s.get(f'https://www.pixiv.net/ajax/illust/{picID}')
-
-        j = r.json()
-        if j['error']:
-            raise WeebException(j['message'])
+        s = self.getSession()
+        info = self.metadata.get(picID) or self.getIllust(s,picID)
 
-        artist = sanitize(j['body']['userName'])
+        artist = sanitize(info['userName'])
         pngDir, jpgDir, sourceDir = self.setupArtistDir(artist)
 
-        basePicTitle = f'{picID}_{j["body"]["illustTitle"]}'
-        pageCount = j['body']['userIllusts'][picID]['pageCount']
+        basePicTitle = f'{picID}_{info["title"]}'
+        pageCount = info['pageCount']
 
         end = '' if pageCount == 1 else f' ({pageCount} pictures)'
         pre = f'{self.picList.index(piclink)+1}. ' if piclink in self.picList else ''
-        with self.lock:
-            print(f'{pre}Downloading {piclink}{end}', flush=True)
+        self._status(f'{pre}Downloading {piclink}{end}')
+
+        isExplicit = info['explicit']
+        infoData = {
+            'piclink': piclink,
+            'artistlink': f'https://www.pixiv.net/en/users/{info["userId"]}',
+            'explicit': isExplicit,
+            'postID': picID,
+            'tags': info['tags'],
+            'rating': 'e' if isExplicit else 's',
+        }
+        index = self.getLocalIndex(artist)
+        # bulk metadata only knows the original path, not if it's png or jpg,
+        # the extension that worked last goes first
+        originals = sorted(info['originals'],key=lambda x: not x.endswith(f'.{self.lastExt}'))
         for p in range(pageCount):
-            picUrl = re.sub('_p0',f'_p{p}',j['body']['urls']['original'])
-            with s.get(picUrl,headers={'referer':piclink},stream=True) as r:
+            for picUrl in originals:
+                r = s.get(re.sub('_p0',f'_p{p}',picUrl),headers={'referer':piclink},stream=True)
+                if r.status_code != 404:
+                    # try the working extension first on the next pages / illusts
+                    originals = [picUrl] + [ x for x in originals if x != picUrl ]
+                    self.lastExt = picUrl.rsplit('.',1)[-1]
+                    break
+                r.close()
+            with r:
                 if r.status_code != 200:
-                    raise WeebException(f'Cannot get original image {r.status_code}')
+                    raise WeebException(f'Cannot get original image {r.status_code}',status=r.status_code)
 
                 ext = 'png' if r.headers['Content-Type'] == 'image/png' else 'jpg'
                 picTitle = sanitize(f'{basePicTitle}_p{p}.{ext}')
                 picDir = pngDir if ext == 'png' else jpgDir
                 picture = picDir / picTitle
 
-                if not self.summary['artists'] and picture.is_file():
+                # same size already on disk, don't read the body
+                cl = r.headers.get('Content-Length')
+                if cl and (local := index.match('pixiv',picID,int(cl),page=p)):
+                    self._status(f'{pre}Already downloaded {local.name}')
+                    self.addPicture(sourceDir,infoData,artist,local,page=p)
+                    continue
+
+                if self.interactive and not self.summary['artists'] and picture.is_file():
                     if pageCount > 1:
                         continue
                     elif askQuestion(f'Picture p{p} already eixsts, continue?')=='n':
                         raise WeebException('User cancelled download')
 
-                with open(picture,'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-
-            if cl := r.headers.get('Content-Length'):
-                fs = picture.stat().st_size
-                if fs != int(cl):
-                    picture.unlink()
-                    raise WeebException(f'{picture} File size mismatch {fs} != {cl}')
-
-            isExplicit = any(x['tag'] == 'R-18' for x in j['body']['tags']['tags'])
-            with self.lock:
-                self.updateInfoFile(sourceDir,{
-                    'piclink': piclink,
-                    'artistlink': f'https://www.pixiv.net/en/users/{j["body"]["tags"]["authorId"]}',
-                    'explicit': isExplicit,
-                })
-                self.summary[ext].append({
-                    'artist': artist,
-                    'picture': picture,
-                    'explicit': isExplicit,
+                with AtomicWriter(picture,int(cl) if cl else None,self.fsync) as w:
+                    for chunk in r.iter_content(chunk_size=2**16):
+                        w.write(chunk)
+                        self._addBytes(len(chunk))
+                    w.commit()
+
+            index.add(picture)
+            self.addPicture(sourceDir,infoData,artist,picture,page=p)
+
+    @staticmethod
+    def isExplicit(tags,xRestrict=None):
+        ''' xRestrict 1 is R-18, 2 is R-18G, both explicit '''
+        return bool(xRestrict) or 'R-18' in tags or 'R-18G' in tags
+
+    def getIllust(self,s,picID):
+        ''' One ajax call for one illust '''
+        j = s.get(f'https://www.pixiv.net/ajax/illust/{picID}').json()
+        if j['error']:
+            raise WeebException(j['message'])
+
+        body = j['body']
+        tags = [ x['tag'] for x in body['tags']['tags'] ]
+        return {
+            'userName': body['userName'],
+            'userId': body['tags']['authorId'],
+            'title': body['illustTitle'],
+            'pageCount': body['userIllusts'][picID]['pageCount'],
+            'tags': tags,
+            'explicit': self.isExplicit(tags,body.get('xRestrict')),
+            'originals': [body['urls']['original']],
+        }
+
+    def isGone(self,s,picID):
+        ''' Only a 404 ajax reply with an error body, anything else keeps the illust '''
+        r = s.get(f'https://www.pixiv.net/ajax/illust/{picID}',cookies=self.cookies)
+        if r.status_code != 404:
+            return False
+        try:
+            return bool(r.json()['error'])
+        except ValueError:
+            return False
+
+    def getIllusts(self,artistID,picIDs,batch=48):
+        '''
+        Bulk metadata of an artist's illusts, batch illusts per ajax call
+        Returns {picID: getIllust data}, missing illusts fall back to getIllust
+        '''
+        metadata = {}
+        with requests.Session() as s:
+            if self.cookies:
+                # logged in, gets R-18 illusts too
+                s.cookies.update(self.cookies)
+            for i in range(0,len(picIDs),batch):
+                r = s.get(f'https://www.pixiv.net/ajax/user/{artistID}/profile/illusts',params={
+                    'ids[]': picIDs[i:i+batch],
+                    'work_category': 'illustManga',
+                    'is_first_page': 0,
                 })
+                try:
+                    # 403 / 429 come back as html pages
+                    j = r.json() if r.status_code == 200 else None
+                except ValueError:
+                    j = None
+                if not j or j['error']:
+                    self.log(f'Bulk metadata error: {j["message"] if j else r.status_code}')
+                    continue
+
+                for picID,w in j['body']['works'].items():
+                    # thumbnail .../img-master/img/<date>/<id>_p0_square1200.jpg
+                    m = re.search(r'/img/(\d{4}(?:/\d\d){5})/(\d+)_p0',w.get('url') or '')
+                    if not m:
+                        continue
+                    base = f'https://i.pximg.net/img-original/img/{m.group(1)}/{m.group(2)}_p0'
+                    metadata[str(picID)] = {
+                        'userName': w['userName'],
+                        'userId': w['userId'],
+                        'title': w['title'],
+                        'pageCount': w['pageCount'],
+                        'tags': w['tags'],
+                        'explicit': self.isExplicit(w['tags'],w.get('xRestrict')),
+                        'originals': [f'{base}.jpg',f'{base}.png'],
+                    }
+        return metadata
+
+    def download_queue(self,piclinks=None):
+        ''' Bulk metadata first so workers go straight to the image bytes '''
+        if self.artistID and not self.jobQueue and not self.plan:
+            todo = piclinks if piclinks is not None else self.checkpoint.pending()
+            picIDs = [ self.checkValid(x,'pixiv','single') for x in todo ]
+            self.log(f'Fetching metadata of {len(picIDs)} illusts')
+            self.metadata.update(self.getIllusts(self.artistID,picIDs))
+        super().download_queue(piclinks)
 
     def download_artist(self,artistlink):
         '''
@@ -89,7 +193,7 @@ class Pixiv(ImageDownloader):
         It's literally recaptcha black magic and the methods change every year
         Just use selenium for stability >_>
         '''
-        artistID = self.checkValid(artistlink,'pixiv','artist')
+        artistID = self.artistID = self.checkValid(artistlink,'pixiv','artist')
 
         # change to ... /artworks
         artistlink = f'https://www.pixiv.net/en/users/{artistID}/artworks'
@@ -98,9 +202,19 @@ class Pixiv(ImageDownloader):
         j = json.loads(soup.find('meta',id='meta-preload-data')['content'])
         artist = j['user'][artistID]['name']
 
-        print(f'Artist: {artist}',flush=True)
+        self.log(f'Artist: {artist}')
 
-        username, password = getUserPass('pixiv')
+        if self.plan:
+            self._planArtist(artistID,artist)
+            return
+
+        resumed = self.startCheckpoint('pixiv',artistID,artistlink)
+        if resumed and self.checkpoint.data['queue'] is not None:
+            self.summary['artists'].append(artist)
+            self.download_queue()
+            return
+
+        username, password = getUserPass('pixiv',interactive=self.interactive)
         self.driver = getSeleniumDriver(headless=False) # headless mode won't log in...
 
         artistDir = self.imgFolder / artist
@@ -108,14 +222,13 @@ class Pixiv(ImageDownloader):
             if not artistDir.is_dir():
                 raise WeebException(f'"{artist}" does not exist')
             piclinks = getJsonData(artistDir / 'source' / 'info.json')['piclinks']['pixiv']
-        elif artistDir.is_dir():
-            if askQuestion(f'"{artist}" already exists, continue?')=='n':
-                raise WeebException('User cancelled download')
-            removeDirs(artistDir)
+        elif artistDir.is_dir() and not resumed and not self.reconcile:
+            self.confirmRemoveArtist(artist,artistDir)
 
         self.summary['artists'].append(artist)
 
         self._login(username,password)
+        self.cookies = { c['name']: c['value'] for c in self.driver.get_cookies() }
 
         # untested, click "keep my email if popup appears to verify"
         # "remind me later" won't have login cookie"
@@ -124,21 +237,24 @@ class Pixiv(ImageDownloader):
                 and any(x.text.lower() == 'remind me later' for x in all_a)):
             raise WeebException('Press "keep your email" on manual pixiv login')
 
-        print('Fetching page 1...',end='',flush=True)
+        self.log('Fetching page 1...',end='')
         self.driver.get(artistlink)
 
-        print('Waiting for images to load...')
+        self.log('Waiting for images to load...')
         soup = self._getPageSoup()
 
-        self.picList = [ f'https://www.pixiv.net{x["href"]}'
-            for x in soup.find_all('a',href=re.compile(r'^/en/artworks/\d+$'))
-            if x.find() ] # this removes duplicates
+        if not resumed:
+            self.picList = [ f'https://www.pixiv.net{x["href"]}'
+                for x in soup.find_all('a',href=re.compile(r'^/en/artworks/\d+$'))
+                if x.find() ] # this removes duplicates
 
         if self.update:
-            updateList = self.getLazyUpdates(self.picList,piclinks,init=True)
+            updateList = self.getLazyUpdates(self.picList,piclinks,init=not resumed)
             if len(updateList) < len(self.picList):
-                self._download(updateList)
+                self.download_queue(updateList)
                 return
+        lastPage = self.checkpoint.data['page'] if resumed else 1
+        self.saveCrawl(lastPage)
 
         pageRe = re.compile(rf'/en/users/{artistID}/artworks\?p=(\d+)')
         pageTag = sorted(
@@ -147,10 +263,13 @@ class Pixiv(ImageDownloader):
 
         if len(pageTag) > 1:
             for page in pageTag[1:]:
-                print(f'Fetching page {pageRe.match(page).group(1)}...',end='',flush=True)
+                pageNum = int(pageRe.match(page).group(1))
+                if pageNum <= lastPage:
+                    continue
+                self.log(f'Fetching page {pageNum}...',end='')
                 self.driver.get(f'https://www.pixiv.net{page}')
 
-                print('Waiting for images to load...')
+                self.log('Waiting for images to load...')
                 soup = self._getPageSoup()
 
                 sizeb4 = len(self.picList)
@@ -161,26 +280,105 @@ class Pixiv(ImageDownloader):
                 if self.update:
                     updateList += self.getLazyUpdates(self.picList[sizeb4:],piclinks)
                     if len(updateList) < len(self.picList):
-                        self._download(updateList)
+                        self.download_queue(updateList)
                         return
+                self.saveCrawl(pageNum)
 
-        self.close()
+        self.quitDriver()
 
         if self.update_all:
             self.picList = self.getAllUpdates(self.picList,piclinks)
             if not self.picList:
+                self.checkpoint.remove()
+                raise WeebException('Everything up to date')
+        elif self.reconcile:
+            self.picList = self.reconcileArtist(artist,self.picList)
+            if not self.picList:
+                self.checkpoint.remove()
                 raise WeebException('Everything up to date')
         else:
             # non logged in vs logged in photos
             r = requests.get(f'https://www.pixiv.net/ajax/user/{artistID}/profile/all')
-            print(f'Pictures without login: {len(r.json()["body"]["illusts"])}')
-            print(f'Pictures with login: {len(self.picList)}')
+            self.log(f'Pictures without login: {len(r.json()["body"]["illusts"])}')
+            self.log(f'Pictures with login: {len(self.picList)}')
+
+        self.download_queue(self.picList)
+
+    def _planArtist(self,artistID,artist):
+        '''
+        Dry run without Chrome / login, the ajax profile lists every illust
+        visible without login (no R-18), newest first like the artworks pages
+        '''
+        artistDir = self.imgFolder / artist
+        if (self.update or self.update_all) and not artistDir.is_dir():
+            raise WeebException(f'"{artist}" does not exist')
+        self.summary['artists'].append(artist)
+
+        body = requests.get(f'https://www.pixiv.net/ajax/user/{artistID}/profile/all').json()['body']
+        picIDs = sorted({ *body['illusts'], *(body.get('manga') or {}) },key=int,reverse=True)
+        self.picList = [ f'https://www.pixiv.net/en/artworks/{x}' for x in picIDs ]
 
-        self._download(self.picList)
+        if self.update or self.update_all:
+            piclinks = getJsonData(artistDir / 'source' / 'info.json')['piclinks']['pixiv']
+            self.download_queue(self.getLazyUpdates(self.picList,piclinks) if self.update
+                else self.getAllUpdates(self.picList,piclinks))
+        elif self.reconcile:
+            todo = self.reconcileArtist(artist,self.picList)
+            # R-18 posts aren't listed without login, they're not gone
+            explicit = getJsonData(artistDir / 'source' / 'info.json').get('explicit',{}).get('pixiv',[])
+            explicitIDs = { self.getPostID(x) for x in explicit }
+            self.pruned = [ x for x in self.pruned if x not in explicitIDs ]
+            self.download_queue(todo)
+        else:
+            self.download_queue(self.picList)
+
+    def getSizes(self,piclinks):
+        ''' With plan_sizes, HEAD requests on the originals of every page '''
+        if not self.planSizes or not piclinks:
+            return super().getSizes(piclinks)
+
+        picIDs = [ self.checkValid(x,'pixiv','single') for x in piclinks ]
+        self.log(f'Fetching metadata of {len(picIDs)} illusts')
+        metadata = self.getIllusts(self.artistID,picIDs)
+
+        def _size(piclink,picID):
+            if not (info := metadata.get(picID)):
+                return None
+            s = self.sessionPool.get()
+            try:
+                total = 0
+                for p in range(info['pageCount']):
+                    for picUrl in info['originals']:
+                        r = s.head(re.sub('_p0',f'_p{p}',picUrl),headers={'referer':piclink})
+                        if r.status_code == 200 and 'Content-Length' in r.headers:
+                            total += int(r.headers['Content-Length'])
+                            break
+                    else:
+                        return None
+                return total
+            finally:
+                self.sessionPool.put(s)
+
+        self.log(f'Fetching sizes of {len(picIDs)} illusts')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as ex:
+            sizes = dict(zip(piclinks,ex.map(_size,piclinks,picIDs)))
+        return { k: v for k,v in sizes.items() if v is not None }
+
+    def login(self):
+        ''' Logged in cookies for ajax calls, Chrome only runs the first time '''
+        if not self.cookies:
+            username, password = getUserPass('pixiv',interactive=self.interactive)
+            self.driver = getSeleniumDriver(headless=False)
+            try:
+                self._login(username,password)
+                self.cookies = { c['name']: c['value'] for c in self.driver.get_cookies() }
+            finally:
+                self.quitDriver()
+        return self.cookies
 
     def _login(self,username,password):
         self.driver.get('https://accounts.pixiv.net/login')
-        print('Logging in pixiv',flush=True)
+        self.log('Logging in pixiv')
         self.driver.find_element('xpath',"//input[@autocomplete='username']").send_keys(username)
         self.driver.find_element('xpath',"//input[@autocomplete='current-password']").send_keys(password)
         self.driver.find_element('xpath',"//button[@type='submit']").click()
@@ -209,7 +407,15 @@ class Pixiv(ImageDownloader):
             raise WeebException(f'Cannot load page {page}')
         return BeautifulSoup(self.driver.page_source,'html.parser')
 
-    def close(self):
+    def quitDriver(self):
         if self.driver:
             self.driver.quit()
             self.driver = None
+
+    def close(self):
+        self.quitDriver()
+        super().close()
+
+        self.metadata = {}
+        self.artistID = None
+        self.cookies = None
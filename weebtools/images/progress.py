@@ -0,0 +1,119 @@
+import json
+import os
+import sys
+import threading
+import time
+
+from pathlib import Path
+
+
+class Progress:
+    '''
+    Download progress / throughput tracker
+    Redraws at a fixed rate from its own thread instead of printing per pic,
+    optionally dumps the same stats as json for monitoring
+    '''
+
+    def __init__(self,total,interval=0.5,statsFile=None,show=True,stream=None):
+        self.total = total
+        self.interval = interval
+        self.statsFile = Path(statsFile) if statsFile else None
+        self.show = show
+        self.stream = stream or sys.stdout
+
+        self.lock = threading.Lock()
+        self.success = 0
+        self.fail = 0
+        self.bytes = 0
+        self.inFlight = 0
+        self.workers = {}
+
+        self._startTime = None
+        self._stopEvent = threading.Event()
+        self._thread = None
+        self._lastLen = 0
+        self._lastPlain = 0
+
+    def start(self):
+        self._startTime = time.monotonic()
+        self._thread = threading.Thread(target=self._run,name='weebtools-progress',daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopEvent.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._draw(final=True)
+
+    def workerStart(self,piclink):
+        with self.lock:
+            self.workers[threading.current_thread().name] = piclink
+
+    def workerDone(self):
+        with self.lock:
+            self.workers[threading.current_thread().name] = 'idle'
+
+    def addBytes(self,n):
+        with self.lock:
+            self.bytes += n
+
+    def finish(self,ok):
+        with self.lock:
+            if ok:
+                self.success += 1
+            else:
+                self.fail += 1
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.monotonic() - self._startTime if self._startTime else 0
+            done = self.success + self.fail
+            rate = done / elapsed if elapsed else 0
+            return {
+                'total': self.total,
+                'done': done,
+                'success': self.success,
+                'fail': self.fail,
+                'inFlight': self.inFlight,
+                'bytes': self.bytes,
+                'elapsed': round(elapsed,3),
+                'imagesPerSec': round(rate,3),
+                'mbPerSec': round(self.bytes / elapsed / 2**20,3) if elapsed else 0,
+                'eta': round((self.total - done) / rate,1) if rate else None,
+                'workers': dict(sorted(self.workers.items())),
+            }
+
+    def _run(self):
+        while not self._stopEvent.wait(self.interval):
+            self._draw()
+
+    def _draw(self,final=False):
+        st = self.stats()
+
+        eta = '--:--' if st['eta'] is None else '{:02d}:{:02d}'.format(*divmod(int(st['eta']),60))
+        busy = sum(1 for x in st['workers'].values() if x != 'idle')
+        line = (f'[{st["done"]}/{st["total"]}] '
+            f'{st["imagesPerSec"]:.2f} img/s '
+            f'{st["mbPerSec"]:.2f} MB/s '
+            f'ETA {eta} '
+            f'in-flight {st["inFlight"]} '
+            f'workers {busy}/{len(st["workers"])} busy')
+        if st['fail']:
+            line += f' fail {st["fail"]}'
+
+        if self.show:
+            if self.stream.isatty():
+                self.stream.write('\r' + line.ljust(self._lastLen) + ('\n' if final else ''))
+                self._lastLen = len(line)
+            elif final or time.monotonic() - self._lastPlain >= 10:
+                # not a terminal (log file / pipe), don't flood it
+                self.stream.write(line + '\n')
+                self._lastPlain = time.monotonic()
+            self.stream.flush()
+
+        if self.statsFile:
+            self.statsFile.parent.mkdir(parents=True,exist_ok=True)
+            tmp = self.statsFile.with_name(self.statsFile.name + '.tmp')
+            tmp.write_text(json.dumps(st,indent=4))
+            os.replace(tmp,self.statsFile)
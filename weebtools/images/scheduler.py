@@ -0,0 +1,106 @@
+import collections
+import threading
+import time
+
+
+class Scheduler:
+    '''
+    Decides which piclink gets submitted next, crawl order
+    Subclasses reorder / hold back piclinks, see policies
+
+    sizes   - {piclink: bytes}, known before download (listing pages), can be partial
+    postIDs - {piclink: int}
+    slots   - download workers
+    '''
+
+    def __init__(self,piclinks,sizes,postIDs,slots):
+        self.sizes = sizes
+        self.postIDs = postIDs
+        self.slots = slots
+        self.queue = collections.deque(self.order(list(piclinks)))
+
+    def order(self,piclinks):
+        return piclinks
+
+    def next(self):
+        ''' None when there's nothing to submit right now '''
+        return self.queue.popleft() if self.queue else None
+
+    def done(self,piclink):
+        pass
+
+    def __len__(self):
+        return len(self.queue)
+
+
+class NewestFirst(Scheduler):
+    ''' Highest post ID first, newest posts land first when an update is behind '''
+
+    def order(self,piclinks):
+        return sorted(piclinks,key=lambda x: self.postIDs.get(x,0),reverse=True)
+
+
+class SmallestFirst(Scheduler):
+    ''' Smallest known size first, unknown sizes last in crawl order '''
+
+    def order(self,piclinks):
+        return sorted(piclinks,key=lambda x: self.sizes.get(x,float('inf')))
+
+
+class Lanes(Scheduler):
+    '''
+    Big files (>= bigSize) and small files in separate lanes,
+    at most a quarter of the workers on big files while small ones are waiting
+    '''
+
+    bigSize = 8 * 2**20
+
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.big = collections.deque(x for x in self.queue if self.sizes.get(x,0) >= self.bigSize)
+        self.small = collections.deque(x for x in self.queue if self.sizes.get(x,0) < self.bigSize)
+        self.bigSlots = max(1,self.slots // 4)
+        self.bigInFlight = set()
+
+    def next(self):
+        if self.big and (len(self.bigInFlight) < self.bigSlots or not self.small):
+            pl = self.big.popleft()
+            self.bigInFlight.add(pl)
+        elif self.small:
+            pl = self.small.popleft()
+        else:
+            return None
+        self.queue.remove(pl)
+        return pl
+
+    def done(self,piclink):
+        self.bigInFlight.discard(piclink)
+
+
+policies = {
+    'crawl': Scheduler,
+    'newest': NewestFirst,
+    'smallest': SmallestFirst,
+    'lanes': Lanes,
+}
+
+
+class RateLimiter:
+    ''' Token bucket shared by every download thread, rate in bytes/s '''
+
+    def __init__(self,rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self._tokens = rate
+        self._last = time.monotonic()
+
+    def consume(self,n):
+        with self.lock:
+            now = time.monotonic()
+            # at most 1 sec of burst
+            self._tokens = min(self.rate,self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
@@ -0,0 +1,166 @@
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+
+from .localIndex import LocalIndex
+from ..utils import getJsonData
+
+
+class TagIndex:
+    '''
+    Global sqlite index of every downloaded pic, across artists
+    One per machine (local disk, WAL doesn't work on network shares),
+    rebuild() indexes an image folder downloaded by other boxes
+    pics    - one row per picture (site, post id, page, artist, rating, path)
+    tags    - inverted index tag -> pic, so tag lookups never touch the image tree
+
+    rating is the yande.re one: s(afe) / q(uestionable) / e(xplicit)
+    pixiv R-18 is e, everything else s
+    '''
+
+    defaultFile = Path.home() / '.weebtools' / 'tags.db'
+
+    piclinks = {
+        'yande': 'https://yande.re/post/show/{}',
+        'pixiv': 'https://www.pixiv.net/en/artworks/{}',
+    }
+
+    def __init__(self,dbFile=None):
+        self.dbFile = Path(dbFile or self.defaultFile)
+        self.dbFile.parent.mkdir(parents=True,exist_ok=True)
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.dbFile,timeout=60,check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS pics (
+                    id          INTEGER PRIMARY KEY,
+                    site        TEXT NOT NULL,
+                    postID      INTEGER NOT NULL,
+                    page        INTEGER NOT NULL DEFAULT 0,
+                    artist      TEXT NOT NULL,
+                    rating      TEXT,
+                    picture     TEXT NOT NULL,
+                    piclink     TEXT,
+                    added       REAL,
+                    UNIQUE (site,postID,page)
+                );
+                CREATE TABLE IF NOT EXISTS tags (
+                    tag         TEXT NOT NULL,
+                    pic         INTEGER NOT NULL REFERENCES pics(id),
+                    PRIMARY KEY (tag,pic)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS pics_artist ON pics (artist);
+                CREATE INDEX IF NOT EXISTS tags_pic ON tags (pic);
+            ''')
+
+    def add(self,site,postID,page,artist,rating,tags,picture,piclink=None):
+        with self.lock, self.db:
+            self._add(site,postID,page,artist,rating,tags,picture,piclink)
+
+    def addMany(self,rows):
+        ''' rows of add() args, one transaction '''
+        with self.lock, self.db:
+            for row in rows:
+                self._add(*row)
+
+    def _add(self,site,postID,page,artist,rating,tags,picture,piclink=None):
+        self.db.execute('''
+            INSERT INTO pics (site,postID,page,artist,rating,picture,piclink,added)
+            VALUES (?,?,?,?,?,?,?,?)
+            ON CONFLICT (site,postID,page) DO UPDATE SET
+                artist = excluded.artist,
+                rating = COALESCE(excluded.rating,rating),
+                picture = excluded.picture,
+                piclink = COALESCE(excluded.piclink,piclink)''',
+            (site,int(postID),page,artist,rating,str(picture),piclink,time.time()))
+        picID = self.db.execute('SELECT id FROM pics WHERE site = ? AND postID = ? AND page = ?',
+            (site,int(postID),page)).fetchone()[0]
+        self.db.execute('DELETE FROM tags WHERE pic = ?',(picID,))
+        self.db.executemany('INSERT OR IGNORE INTO tags (tag,pic) VALUES (?,?)',
+            [ (t.lower(),picID) for t in tags ])
+
+    def remove(self,site,postID):
+        with self.lock, self.db:
+            ids = [ x[0] for x in self.db.execute(
+                'SELECT id FROM pics WHERE site = ? AND postID = ?',(site,int(postID))) ]
+            self.db.executemany('DELETE FROM tags WHERE pic = ?',[ (x,) for x in ids ])
+            self.db.executemany('DELETE FROM pics WHERE id = ?',[ (x,) for x in ids ])
+
+    def query(self,tags=(),artist=None,rating=None,site=None,limit=None):
+        '''
+        Pics having every tag in tags, tags ending with * are prefix matches
+        Returns [{site, postID, page, artist, rating, picture, piclink}]
+        '''
+        where, params = [], []
+        for t in tags:
+            t = t.lower()
+            if t.endswith('*'):
+                # range scan on the tag primary key
+                where.append('id IN (SELECT pic FROM tags WHERE tag >= ? AND tag < ?)')
+                params += [t[:-1],t[:-1] + '\uffff']
+            else:
+                where.append('id IN (SELECT pic FROM tags WHERE tag = ?)')
+                params.append(t)
+        for col,val in (('artist',artist),('rating',rating),('site',site)):
+            if val:
+                where.append(f'{col} = ?')
+                params.append(val)
+
+        sql = 'SELECT site,postID,page,artist,rating,picture,piclink FROM pics'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY site, postID DESC, page'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+
+        cols = ('site','postID','page','artist','rating','picture','piclink')
+        with self.lock:
+            return [ dict(zip(cols,x)) for x in self.db.execute(sql,params) ]
+
+    def rebuild(self,imgFolder):
+        '''
+        Indexes pics already in imgFolder from their file names,
+        yande.re file names carry the tags, rating comes from info.json explicit lists
+        Returns number of pics indexed
+        '''
+        total = 0
+        for artistDir in sorted(x for x in imgFolder.iterdir() if x.is_dir()):
+            explicit = getJsonData(artistDir / 'source' / 'info.json').get('explicit',{})
+            rows = []
+            for d in ('png','jpg'):
+                if not (artistDir / d).is_dir():
+                    continue
+                for pic in (artistDir / d).glob(f'*.{d}'):
+                    for site,com in LocalIndex.patterns.items():
+                        if m := com.match(pic.name):
+                            break
+                    else:
+                        continue
+                    postID = int(m.group(1))
+                    page = int(m.group(2)) if com.groups > 1 else 0
+                    tags = pic.stem.split(' ')[2:] if site == 'yande' else []
+                    piclink = self.piclinks[site].format(postID)
+                    rating = 'e' if piclink in explicit.get(site,[]) else None
+                    rows.append((site,postID,page,artistDir.name,rating,tags,pic,piclink))
+            self.addMany(rows)
+            total += len(rows)
+        return total
+
+    def postIDs(self,site):
+        ''' Every downloaded post ID of site '''
+        with self.lock:
+            return { x[0] for x in self.db.execute(
+                'SELECT DISTINCT postID FROM pics WHERE site = ?',(site,)) }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM pics').fetchone()[0]
@@ -0,0 +1,245 @@
+import concurrent.futures
+import datetime
+import random
+import re
+import time
+
+from pathlib import Path
+
+from .api import downloaders, getLinkType
+from .imageDownloader import ImageDownloader
+from .scheduler import RateLimiter
+from .tagIndex import TagIndex
+from ..utils import getJsonData, getSS, writeJsonData, SessionPool
+from ..weebException import WeebException
+
+
+class Watcher:
+    '''
+    Long running poller of followed artists (yande.re artist tags, pixiv users)
+
+    Everything a cron run rebuilds each time is kept warm: http sessions,
+    download threads, pixiv login cookies and the catalog of downloaded post IDs
+    (tag index, updated as pics complete)
+
+    Each artist gets its own poll interval, halved when new posts showed up,
+    1.5x longer when there was nothing new, within minInterval / maxInterval
+    New posts are downloaded right away, like --update
+
+    watch.json          - {"follow": [artistlink], "minInterval": secs, "maxInterval": secs}
+    watch_state.json    - {artistlink: {interval, nextCheck, lastCheck, lastNew}}
+    '''
+
+    configFile = Path.home() / '.weebtools' / 'watch.json'
+    stateFile = Path.home() / '.weebtools' / 'watch_state.json'
+
+    minInterval = 15 * 60
+    maxInterval = 24 * 3600
+    startInterval = 3600
+
+    def __init__(self,configFile=None,**options):
+        '''
+        options - downloader options (workers, fsync, schedule, max_rate...),
+                  there's no progress line, pics are logged per artist
+        '''
+        self.configFile = Path(configFile or self.configFile)
+        self._configMtime = None
+        self.follow = []
+
+        self.state = getJsonData(self.stateFile)
+        self.sessionPool = SessionPool()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.get('workers') or 4)
+        self.tagIndex = TagIndex(options.get('tag_db'))
+        self.catalogs = {}
+        self.pixivCookies = None
+
+        self.options = {
+            **options,
+            'progress': False,
+            'interactive': False,
+            'executor': self.executor,
+            'session_pool': self.sessionPool,
+            'tag_index': self.tagIndex,
+            'rate_limiter': RateLimiter(options['max_rate']) if options.get('max_rate') else None,
+            'on_result': self._onResult,
+        }
+        self.loadConfig()
+
+    def loadConfig(self):
+        ''' (Re)reads watch.json when it changed, edits apply without a restart '''
+        if not self.configFile.is_file():
+            return
+        mtime = self.configFile.stat().st_mtime
+        if mtime == self._configMtime:
+            return
+        self._configMtime = mtime
+
+        config = getJsonData(self.configFile)
+        self.follow = config.get('follow',[])
+        self.minInterval = config.get('minInterval',self.minInterval)
+        self.maxInterval = config.get('maxInterval',self.maxInterval)
+        for link in self.follow:
+            self.state.setdefault(link,{
+                'interval': self.startInterval,
+                'nextCheck': 0,
+                'lastCheck': None,
+                'lastNew': None,
+            })
+
+    def saveConfig(self):
+        config = getJsonData(self.configFile)
+        config['follow'] = self.follow
+        writeJsonData(config,self.configFile)
+        self.loadConfig()
+
+    def add(self,links):
+        for link in links:
+            if getLinkType(link)[1] != 'artist':
+                raise WeebException(f'Not an artist link: {link}')
+        self.follow += [ x for x in links if x not in self.follow ]
+        self.saveConfig()
+
+    def remove(self,links):
+        self.follow = [ x for x in self.follow if x not in links ]
+        for link in links:
+            self.state.pop(link,None)
+        self.saveConfig()
+        writeJsonData(self.state,self.stateFile)
+
+    def log(self,msg):
+        now = datetime.datetime.now().strftime('%m-%d-%Y %I:%M:%S %p')
+        print(f'[{now}] {msg}',flush=True)
+
+    def run(self,once=False):
+        ''' Polls due artists until Ctrl-C, once checks every artist one time '''
+        if not self.follow:
+            raise WeebException(f'No artists followed in {self.configFile}')
+
+        if not self.tagIndex.count():
+            # first run, catalog comes from the tag index
+            self.log(f'Indexing {ImageDownloader.imgFolder}')
+            self.tagIndex.rebuild(ImageDownloader.imgFolder)
+        self.log(f'Watching {len(self.follow)} artists from {self.configFile}')
+
+        try:
+            while True:
+                self.loadConfig()
+                now = time.time()
+                due = sorted((x for x in self.follow if once or self.state[x]['nextCheck'] <= now),
+                    key=lambda x: self.state[x]['nextCheck'])
+                for link in due:
+                    self.check(link)
+                if once:
+                    break
+                if not due:
+                    nextCheck = min((self.state[x]['nextCheck'] for x in self.follow),default=now+60)
+                    # wake up at least every minute for watch.json edits
+                    time.sleep(min(60,max(1,nextCheck - now)))
+        except KeyboardInterrupt:
+            self.log('Stopped')
+        finally:
+            self.executor.shutdown()
+            self.tagIndex.close()
+
+    def check(self,link):
+        ''' Downloads new posts of link, reschedules it '''
+        site, _ = getLinkType(link)
+        entry = self.state[link]
+        try:
+            new = self.checkYande(link) if site == 'yande' else self.checkPixiv(link)
+        except Exception as e:
+            self.log(f'{link} check failed: {e}')
+            new = 0
+
+        now = time.time()
+        entry['lastCheck'] = now
+        if new:
+            entry['lastNew'] = now
+            entry['interval'] = max(self.minInterval,entry['interval'] / 2)
+        else:
+            entry['interval'] = min(self.maxInterval,entry['interval'] * 1.5)
+        # spread artists out, no burst of requests every interval
+        entry['nextCheck'] = now + entry['interval'] * random.uniform(0.9,1.1)
+        writeJsonData(self.state,self.stateFile)
+
+    def checkYande(self,link):
+        ''' Page 1 of the listing, lazy update crawl if every post of it is new '''
+        s = self.sessionPool.get()
+        try:
+            _, soup = getSS(link,s)
+        finally:
+            self.sessionPool.put(s)
+
+        postIDs = list(dict.fromkeys(int(x['href'].rsplit('/',1)[1])
+            for x in soup.find_all('a',href=re.compile(r'/post/show/\d+$'))))
+        new = [ x for x in postIDs if x not in self.getCatalog('yande') ]
+        if not new:
+            return 0
+
+        d = downloaders['yande'](**self.options)
+        artist = d.getArtist(link,soup)
+        self.log(f'{artist}: {len(new)} new posts')
+        if len(new) == len(postIDs) and soup.find('div',id='paginator').find_all('a'):
+            # more new posts past page 1
+            d.update = (d.imgFolder / artist).is_dir()
+            try:
+                d.download_artist(link)
+            except WeebException as e:
+                if str(e) != 'Everything up to date':
+                    raise
+                return 0
+        else:
+            d.summary['artists'].append(artist)
+            d.updateHints(soup)
+            d.download_queue([ f'https://yande.re/post/show/{x}' for x in new ])
+        self.logResult(artist,d)
+        return len(new)
+
+    def checkPixiv(self,link):
+        ''' ajax profile with the login cookies, lists every illust, R-18 included '''
+        artistID = ImageDownloader.checkValid(link,'pixiv','artist')
+        d = downloaders['pixiv'](**self.options)
+        if not self.pixivCookies:
+            self.log('Logging in pixiv')
+            self.pixivCookies = d.login()
+
+        s = self.sessionPool.get()
+        try:
+            j = s.get(f'https://www.pixiv.net/ajax/user/{artistID}/profile/all',
+                cookies=self.pixivCookies).json()
+        finally:
+            self.sessionPool.put(s)
+        if j['error']:
+            # login expired, next check logs in again
+            self.pixivCookies = None
+            raise WeebException(j['message'])
+
+        body = j['body']
+        postIDs = sorted({ *body['illusts'], *(body.get('manga') or {}) },key=int,reverse=True)
+        new = [ x for x in postIDs if int(x) not in self.getCatalog('pixiv') ]
+        if not new:
+            return 0
+
+        self.log(f'pixiv user {artistID}: {len(new)} new posts')
+        d.artistID = artistID
+        d.cookies = self.pixivCookies
+        d.download_queue([ f'https://www.pixiv.net/en/artworks/{x}' for x in new ])
+        self.logResult(f'pixiv user {artistID}',d)
+        return len(new)
+
+    def getCatalog(self,site):
+        ''' Downloaded post IDs of site, loaded once '''
+        if site not in self.catalogs:
+            self.catalogs[site] = self.tagIndex.postIDs(site)
+        return self.catalogs[site]
+
+    def _onResult(self,piclink,pictures,error):
+        # failed pics too, they're retried with retry_failed not on every poll
+        site, _ = getLinkType(piclink)
+        self.getCatalog(site).add(int(ImageDownloader.checkValid(piclink,site,'single')))
+
+    def logResult(self,artist,d):
+        msg = f'{artist}: {len(d.summary["success"])} downloaded'
+        if d.summary['fail']:
+            msg += f', {len(d.summary["fail"])} failed (retry_failed)'
+        self.log(msg)
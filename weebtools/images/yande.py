@@ -6,9 +6,10 @@ import sys
 from bs4 import BeautifulSoup
 from pathlib import Path
 
+from .fileWriter import AtomicWriter
 from .imageDownloader import ImageDownloader
 from ..utils import (
-    getSS, removeDirs, askQuestion, getHash, sanitize, getJsonData
+    getSS, askQuestion, getHash, sanitize, getJsonData
 )
 from ..weebException import WeebException
 
@@ -18,6 +19,8 @@ Yes, I'm aware there's an api for this, but it has its limitations
 
 class Yande(ImageDownloader):
 
+    site = 'yande'
+
     def __init__(self,*args,**kwargs):
         super().__init__(*args,**kwargs)
 
@@ -26,10 +29,9 @@ class Yande(ImageDownloader):
         self.checkValid(piclink,'yande','single')
 
         pre = f'{self.picList.index(piclink)+1}. ' if piclink in self.picList else ''
-        with self.lock:
-            print(f'{pre}Downloading {piclink}',flush=True)
+        self._status(f'{pre}Downloading {piclink}')
 
-        s, soup = getSS(piclink)
+        s, soup = getSS(piclink,self.getSession())
 
         artist = 'NO_ARTIST'
         tagTypes = [
@@ -63,12 +65,36 @@ class Yande(ImageDownloader):
         # for example https://yande.re/post/show/697638
         if respInfo['file_url'] != realTag['href']:
             # File url differ
-            print(f'NOTE: FILE URL DIFFER {piclink}')
+            self.log(f'NOTE: FILE URL DIFFER {piclink}')
+
+        isExplicit = any(re.match('Rating: Explicit',li.text) for li in soup.find_all('li'))
+        infoData = {
+            'piclink': piclink,
+            'artistlink': f'https://yande.re{t["href"]}' if artist != 'NO_ARTIST' else None,
+            'explicit': isExplicit,
+            'postID': respInfo['id'],
+            'tags': respInfo['tags'].split(),
+            'rating': respInfo.get('rating') or ('e' if isExplicit else None),
+        }
+
+        # same size / md5 already on disk (info.json missing or stale), skip the transfer
+        index = self.getLocalIndex(artist)
+        if picture := index.match('yande',respInfo['id'],respInfo['file_size'],respInfo['md5']):
+            self._status(f'{pre}Already downloaded {picture.name}')
+            self.addPicture(sourceDir,infoData,artist,picture)
+            return
+
+        # big originals: headers from a HEAD, the body comes as parallel byte ranges
+        # (single stream is too slow on high latency routes), no GET opened for nothing
+        ranged = False
+        if respInfo['file_size'] >= self.segmentThreshold:
+            head = s.head(respInfo['file_url'],allow_redirects=True)
+            ranged = head.status_code == 200 and head.headers.get('Accept-Ranges') == 'bytes'
 
         # stream download, uses file_url in the js obj
-        with s.get(respInfo['file_url'],stream=True) as r:
+        with (head if ranged else s.get(respInfo['file_url'],stream=True)) as r:
             if r.status_code != 200:
-                raise WeebException(f'Image file_url error: {r.status_code}')
+                raise WeebException(f'Image file_url error: {r.status_code}',status=r.status_code)
             if respInfo['file_size'] != int(r.headers['Content-Length']):
                 raise WeebException('File size server mismatch ?')
 
@@ -96,94 +122,136 @@ class Yande(ImageDownloader):
                         ['yande.re',artid,] + sortedTags) + f'.{ext}')
                     picture = picDir / picTitle
 
-            if (not self.summary['artists'] and picture.is_file()
+            if (self.interactive and not self.summary['artists'] and picture.is_file()
                     and askQuestion('Photo already exists, continue?')=='n'):
                 raise WeebException('User cancelled download')
 
-            with open(picture,'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            with AtomicWriter(picture,respInfo['file_size'],self.fsync) as w:
+                if ranged:
+                    w.written += self.downloadRanges(s,respInfo['file_url'],w.tmp,respInfo['file_size'])
+                else:
+                    for chunk in r.iter_content(chunk_size=2**16):
+                        w.write(chunk)
+                        self._addBytes(len(chunk))
+                w.close()
 
-        fileSize = picture.stat().st_size
-        respSize = respInfo['file_size']
-        if fileSize != respSize:
-            picture.unlink()
-            raise WeebException(f'{picture} File size mismatch {fileSize} != {respSize}')
+                if getHash('md5',w.tmp) != respInfo['md5']:
+                    raise WeebException('md5 checksum failure')
+                w.commit()
 
-        if getHash('md5',picture) != respInfo['md5']:
-            picture.unlink()
-            raise WeebException('md5 checksum failure')
-
-        isExplicit = any(re.match('Rating: Explicit',li.text) for li in soup.find_all('li'))
-        with self.lock:
-            self.updateInfoFile(sourceDir,{
-                'piclink': piclink,
-                'artistlink': f'https://yande.re{t["href"]}' if artist != 'NO_ARTIST' else None,
-                'explicit': isExplicit,
-            })
-            self.summary[ext].append({
-                'artist': artist,
-                'picture': picture,
-                'explicit': isExplicit,
-            })
+        index.add(picture,md5=respInfo['md5'])
+        self.addPicture(sourceDir,infoData,artist,picture)
 
     def download_artist(self,artistlink):
         ''' Group download for artist '''
         self.checkValid(artistlink,'yande','artist')
 
         s, soup = getSS(artistlink)
+        artist = self.getArtist(artistlink,soup)
 
-        getText = lambda x: x.find('a',href=re.compile('/post\?tags=.*')).text
-        title = getText(soup.find('h2',id='site-title'))
-        try:
-            artist = getText(soup.find('li',class_='tag-type-artist'))
-            assert title == artist
-        except (AttributeError,AssertionError):
-            raise WeebException(f'{artistlink} is not an artist link')
+        self.log(f'Artist: {artist}')
 
-        print(f'Artist: {artist}')
+        resumed = self.startCheckpoint('yande',artist,artistlink)
+        if resumed and self.checkpoint.data['queue'] is not None:
+            self.summary['artists'].append(artist)
+            self.download_queue()
+            return
 
         artistDir = self.imgFolder / artist
         if self.update or self.update_all:
             if not artistDir.is_dir():
                 raise WeebException(f'"{artist}" does not exist')
             piclinks = getJsonData(artistDir / 'source' / 'info.json')['piclinks']['yande']
-        elif artistDir.is_dir():
-            if askQuestion(f'"{artist}" already exists, continue?')=='n':
-                raise WeebException('User cancelled download')
-            removeDirs(artistDir)
+        elif artistDir.is_dir() and not resumed and not self.reconcile:
+            self.confirmRemoveArtist(artist,artistDir)
 
         self.summary['artists'].append(artist)
 
-        print('Fetching page 1')
-        self.picList = [ 'https://yande.re'+x['href']
-                for x in soup.find_all('a',href=re.compile('/post/show/\d+$')) ]
+        startPage = self.checkpoint.data['page'] + 1 if resumed else 2
+        if not resumed:
+            self.log('Fetching page 1')
+            self.picList = [ 'https://yande.re'+x['href']
+                    for x in soup.find_all('a',href=re.compile('/post/show/\d+$')) ]
+            self.updateHints(soup)
 
         if self.update:
-            updateList = self.getLazyUpdates(self.picList,piclinks,init=True)
+            updateList = self.getLazyUpdates(self.picList,piclinks,init=not resumed)
             if len(updateList) < len(self.picList):
-                self._download(updateList)
+                self.download_queue(updateList)
                 return
+        self.saveCrawl(startPage-1)
 
         if pageTag := soup.find('div',id='paginator').find_all('a'):
             p2href = pageTag[0]['href']
-            for page in range(2,int(pageTag[-2].text)+1):
-                print(f'Fetching page {page}')
+            for page in range(startPage,int(pageTag[-2].text)+1):
+                self.log(f'Fetching page {page}')
                 pageLink = 'https://yande.re'+re.sub('page=2',f'page={page}',p2href)
                 s, soup = getSS(pageLink,s)
                 sizeb4 = len(self.picList)
                 self.picList += [ 'https://yande.re'+x['href']
                     for x in soup.find_all('a',href=re.compile('/post/show/\d+$')) ]
+                self.updateHints(soup)
 
                 if self.update:
                     updateList += self.getLazyUpdates(self.picList[sizeb4:],piclinks)
                     if len(updateList) < len(self.picList):
-                        self._download(updateList)
+                        self.download_queue(updateList)
                         return
+                self.saveCrawl(page)
 
         if self.update_all:
             self.picList = self.getAllUpdates(self.picList,piclinks)
-            if not self.picList:
+            if not self.picList and not self.plan:
+                self.checkpoint.remove()
+                raise WeebException('Everything up to date')
+        elif self.reconcile:
+            self.picList = self.reconcileArtist(artist,self.picList)
+            if not self.picList and not self.plan:
+                self.checkpoint.remove()
                 raise WeebException('Everything up to date')
 
-        self._download(self.picList)
+        self.download_queue(self.picList)
+
+    def getArtist(self,artistlink,soup):
+        ''' Artist tag of a listing page, raises if the tag isn't an artist '''
+        getText = lambda x: x.find('a',href=re.compile('/post\?tags=.*')).text
+        title = getText(soup.find('h2',id='site-title'))
+        try:
+            artist = getText(soup.find('li',class_='tag-type-artist'))
+            assert title == artist
+        except (AttributeError,AssertionError):
+            raise WeebException(f'{artistlink} is not an artist link')
+        return artist
+
+    def isGone(self,s,postID):
+        ''' 404, or the post page of a deleted post '''
+        r = s.get(f'https://yande.re/post/show/{postID}')
+        if r.status_code == 404:
+            return True
+        if r.status_code != 200:
+            raise WeebException(f'Post {postID} {r.status_code}',status=r.status_code)
+        return 'This post was deleted' in r.text
+
+    def updateHints(self,soup):
+        '''
+        Fills sizeHints / md5Hints from the posts json a listing page
+        registers (Post.register_resp / Post.register), for the scheduler and reconcile
+        '''
+        decoder = json.JSONDecoder()
+        for script in soup.find_all('script'):
+            text = script.text
+            for m in re.finditer(r'Post\.register(?:_resp)?\(',text):
+                try:
+                    obj, _ = decoder.raw_decode(text,m.end())
+                except ValueError:
+                    continue
+                if not isinstance(obj,dict):
+                    continue
+                for post in obj.get('posts',[obj]):
+                    if 'id' not in post:
+                        continue
+                    piclink = f'https://yande.re/post/show/{post["id"]}'
+                    if 'file_size' in post:
+                        self.sizeHints[piclink] = post['file_size']
+                    if post.get('md5'):
+                        self.md5Hints[piclink] = post['md5']
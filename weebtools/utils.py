@@ -1,5 +1,6 @@
 import base64
 import binascii
+import contextlib
 import crc32c
 import getpass
 import hashlib
@@ -12,6 +13,7 @@ import shutil
 import subprocess as sp
 import struct
 import sys
+import threading
 import time
 import zipfile
 
@@ -66,17 +68,51 @@ def getHash(func,x):
 
     return h.hexdigest()
 
+_VERSION_CACHE = _APP_DIR / 'versions.json'
+_versionCache = {}
+
+def _cachedVersion(binary,probe):
+    '''
+    probe() result for binary, cached (in memory and _VERSION_CACHE)
+    until the binary mtime changes, saves a process spawn per call
+    '''
+    try:
+        mtime = os.stat(binary).st_mtime
+    except (OSError,TypeError):
+        return probe()
+
+    key = str(binary)
+    if not _versionCache and _VERSION_CACHE.is_file():
+        try:
+            _versionCache.update(json.loads(_VERSION_CACHE.read_text()))
+        except ValueError:
+            pass
+
+    if (hit := _versionCache.get(key)) and hit[0] == mtime:
+        return hit[1]
+
+    version = probe()
+    if version:
+        _versionCache[key] = (mtime,version)
+        _VERSION_CACHE.write_text(json.dumps(_versionCache,indent=4))
+    return version
+
 def getChromeVersion():
     '''
     returns MAJOR.MINOR.BUILD.PATCH
     returns None if chrome not installed / other error
     '''
     if sys.platform != 'win32':
-        try:
-            p = sp.run(['google-chrome','--version'],stdout=sp.PIPE).stdout.decode('utf-8')
-            return p.strip().split()[-1]
-        except:
+        chrome = shutil.which('google-chrome')
+        if not chrome:
             return None
+        def _probe():
+            try:
+                p = sp.run([chrome,'--version'],stdout=sp.PIPE).stdout.decode('utf-8')
+                return p.strip().split()[-1]
+            except:
+                return None
+        return _cachedVersion(chrome,_probe)
 
     from win32com.client import Dispatch
     from winreg import OpenKey, HKEY_LOCAL_MACHINE, QueryValueEx
@@ -89,7 +125,9 @@ def getChromeVersion():
         'chrome.exe')
     try:
         with OpenKey(HKEY_LOCAL_MACHINE,chromeRegistryPath) as regKey:
-            return Dispatch("Scripting.FileSystemObject").GetFileVersion(QueryValueEx(regKey,'')[0])
+            chrome = QueryValueEx(regKey,'')[0]
+        return _cachedVersion(chrome,
+            lambda: Dispatch("Scripting.FileSystemObject").GetFileVersion(chrome))
     except FileNotFoundError:
         print('Chrome not installed?')
     except Exception as e:
@@ -105,8 +143,10 @@ def getChromeDriverVersion():
     if not chromeDriver.is_file():
         return None
 
-    p = sp.run([chromeDriver,'--version'],stdout=sp.PIPE).stdout.decode('utf-8')
-    return p.split()[1]
+    def _probe():
+        p = sp.run([chromeDriver,'--version'],stdout=sp.PIPE).stdout.decode('utf-8')
+        return p.split()[1]
+    return _cachedVersion(chromeDriver,_probe)
 
 def downloadChromeDriver():
     '''
@@ -138,14 +178,19 @@ def downloadChromeDriver():
     print(f'Downloading ChromeDriver',flush=True)
 
     zipFile = _APP_DIR / f'chromedriver_win32_{newVer}.zip'
+    # checksums computed while streaming, the zip is never loaded in memory
+    crc = 0
+    md5Hash = hashlib.md5()
     with requests.get(f'{base}/{newVer}/chromedriver_win32.zip',stream=True) as r:
         if not r.status_code == 200:
             print(f'Error getting new ChromeDriver: {r.status_code}')
             return
 
         with open(zipFile,'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
+            for chunk in r.iter_content(chunk_size=2**16):
                 f.write(chunk)
+                crc = crc32c.crc32c(chunk,crc)
+                md5Hash.update(chunk)
 
     print('Validating download',flush=True)
     fileSize = zipFile.stat().st_size
@@ -158,13 +203,12 @@ def downloadChromeDriver():
     hashes = dict(x.split('=',1) for x in r.headers['x-goog-hash'].split(', '))
 
     # https://github.com/ICRAR/crc32c/issues/14
-    zipBytes = zipFile.read_bytes()
-    if hashes['crc32c'] != base64.b64encode(struct.pack('>I',crc32c.crc32c(zipBytes))).decode('utf-8'):
+    if hashes['crc32c'] != base64.b64encode(struct.pack('>I',crc)).decode('utf-8'):
         zipFile.unlink()
         print('crc32c checksumn failure')
         return
 
-    md5 = getHash('md5',zipBytes)
+    md5 = md5Hash.hexdigest()
     if hashes['md5'] != base64.b64encode(binascii.unhexlify(md5)).decode('utf-8'):
         zipFile.unlink()
         print('md5 checksum failure')
@@ -202,9 +246,29 @@ def getSS(link,session=None,parser='html.parser'):
     s = session if session else requests.Session()
     r = s.get(link)
     if r.status_code != 200:
-        raise WeebException(f'{link} {r.status_code}')
+        raise WeebException(f'{link} {r.status_code}',status=r.status_code)
     return s, BeautifulSoup(r.content,parser)
 
+class SessionPool:
+    '''
+    Reusable requests sessions (keep-alive connections) for worker threads
+    A session is only used by one thread at a time: get() -> work -> put()
+    '''
+
+    def __init__(self):
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._sessions:
+                return self._sessions.pop()
+        return requests.Session()
+
+    def put(self,session):
+        with self._lock:
+            self._sessions.append(session)
+
 def makeDirs(*dirs):
     for d in dirs:
         d.mkdir(parents=True,exist_ok=True)
@@ -229,13 +293,162 @@ def getJsonData(jFile):
         return json.load(f)
 
 def writeJsonData(jData,jFile):
-    with open(jFile,'w') as f:
+    # readers never see a half written file
+    tmp = jFile.with_name(jFile.name + '.tmp')
+    with open(tmp,'w') as f:
         json.dump(jData,f,indent=4)
+    os.replace(tmp,jFile)
+
+@contextlib.contextmanager
+def fileLock(path):
+    ''' Cross process lock on <path>.lock, blocks until acquired '''
+    with open(f'{path}.lock','a+') as f:
+        if sys.platform == 'win32':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    # gives up after 10 tries (~10 secs)
+                    msvcrt.locking(f.fileno(),msvcrt.LK_LOCK,1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(),msvcrt.LK_UNLCK,1)
+        else:
+            import fcntl
+            fcntl.flock(f,fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f,fcntl.LOCK_UN)
 
 def sanitize(x):
     return re.sub(r'[\\/:*?"<>|]','_',x).strip('.')
 
-def getUserPass(site):
+_ENC_FILE = _APP_DIR / 'wt.enc'
+_PEM_FILE = _APP_DIR / 'wt.pem'
+_KEY_FILE = _APP_DIR / 'wt.key'
+_KEY_SCHEMES = ('rsa','file')
+
+_OAEP = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None)
+
+# decrypted credentials of every site, shared by the whole process
+_credentials = {'data': None, 'expires': 0}
+_credentialsLock = threading.Lock()
+
+def _keyFile(scheme):
+    return _KEY_FILE if scheme == 'file' else _PEM_FILE
+
+def _writeSecret(path,data):
+    ''' Owner read / write only from creation, flushed to disk '''
+    path.unlink(missing_ok=True)
+    fd = os.open(path,os.O_WRONLY | os.O_CREAT | os.O_EXCL,0o600)
+    with os.fdopen(fd,'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _writeEncrypted(ed):
+    tmp = _ENC_FILE.with_name(_ENC_FILE.name + '.tmp')
+    _writeSecret(tmp,pickle.dumps(ed))
+    os.replace(tmp,_ENC_FILE)
+
+def _unwrapKey(ed):
+    '''
+    Returns the Fernet data key of an encrypted file
+    <key file>.new is the key of a rewrap that died after replacing wt.enc,
+    it's tried second and moved in place if it's the one
+    '''
+    scheme = ed.get('scheme','rsa')
+    keyFile = _keyFile(scheme)
+    pending = keyFile.with_name(keyFile.name + '.new')
+    if not keyFile.is_file() and not pending.is_file():
+        raise WeebException(f'ERROR: DECRYPTION KEY {keyFile} MISSING!!!')
+
+    for path in (keyFile,pending):
+        if not path.is_file():
+            continue
+        try:
+            if scheme == 'file':
+                fk = path.read_bytes()
+            else:
+                fk = load_pem_private_key(path.read_bytes(),None).decrypt(ed['k'],_OAEP)
+            Fernet(fk).decrypt(ed['d'])
+        except (ValueError,InvalidToken):
+            continue
+        if path == pending:
+            os.replace(pending,keyFile)
+        return fk
+
+    raise WeebException(f'ERROR: DECRYPTION FAILED, KEY {keyFile} OR {_ENC_FILE} TAMPERRED??')
+
+def _wrapKey(ed,fk,scheme,keyFile=None):
+    '''
+    Stores the Fernet data key fk for ed with scheme
+    rsa  - 4096 bit RSA OAEP wrapped, private key in wt.pem (seconds to generate)
+    file - key as is in wt.key, no RSA cost at all
+    Both are owner read / write only, keyFile overrides where the key goes
+    '''
+    if scheme not in _KEY_SCHEMES:
+        raise WeebException(f'Key scheme must be one of {_KEY_SCHEMES}')
+
+    ed['scheme'] = scheme
+    keyFile = keyFile or _keyFile(scheme)
+    if scheme == 'file':
+        _writeSecret(keyFile,fk)
+        ed.pop('k',None)
+        return
+
+    ek = rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=4096,
+        backend=default_backend())
+    _writeSecret(keyFile,ek.private_bytes(
+        encoding=Encoding.PEM,
+        format=PrivateFormat.PKCS8,
+        encryption_algorithm=NoEncryption()))
+    ed['k'] = ek.public_key().encrypt(fk,_OAEP)
+
+def _loadEncrypted():
+    try:
+        return pickle.loads(_ENC_FILE.read_bytes())
+    except pickle.UnpicklingError:
+        raise WeebException('Corrupted encrypted file?')
+
+def rewrapKey(scheme):
+    '''
+    Switches how the data key of wt.enc is stored (rsa / file)
+    Credentials are encrypted again with a new data key, old key files can't read them
+    New key goes to <key file>.new, then wt.enc, then the key is moved in place,
+    a crash at any point leaves a key that decrypts wt.enc (see _unwrapKey)
+    '''
+    if not _ENC_FILE.is_file():
+        raise WeebException(f'{_ENC_FILE} does not exist, nothing to rewrap')
+    if scheme not in _KEY_SCHEMES:
+        raise WeebException(f'Key scheme must be one of {_KEY_SCHEMES}')
+    ed = _loadEncrypted()
+    oldScheme = ed.get('scheme','rsa')
+    data = Fernet(_unwrapKey(ed)).decrypt(ed['d'])
+
+    fk = Fernet.generate_key()
+    new = {'d': Fernet(fk).encrypt(data)}
+    keyFile = _keyFile(scheme)
+    pending = keyFile.with_name(keyFile.name + '.new')
+    _wrapKey(new,fk,scheme,pending)
+    _writeEncrypted(new)
+    os.replace(pending,keyFile)
+    if oldScheme != scheme:
+        _keyFile(oldScheme).unlink(missing_ok=True)
+    print(f'Key scheme {oldScheme} -> {scheme}')
+
+def getUserPass(site,ttl=3600,keyScheme=None,interactive=True):
     '''
     Encrypts a file with username / password on disk,
     asks for credentials if not given already.
@@ -248,11 +461,28 @@ def getUserPass(site):
     You should ONLY use it if you’re 100% absolutely sure
     that you know what you’re doing because this module is full of
     land mines, dragons, and dinosaurs with laser guns.
+
+    ttl         - secs the decrypted credentials (every site) stay cached in memory,
+                  so batch / daemon runs only unwrap the key once
+    keyScheme   - data key storage for a new wt.enc, rsa / file (see _wrapKey)
+                  default $WEEBTOOLS_KEY_SCHEME or rsa
+    interactive - False raises instead of asking when site has no stored credentials
     '''
-    print(f'Getting login info for {site}')
+    with _credentialsLock:
+        j = _credentials['data']
+        if j and j.get(site) and time.monotonic() < _credentials['expires']:
+            return j[site]['username'], j[site]['password']
+
+        j = _getUserPass(site,keyScheme or os.environ.get('WEEBTOOLS_KEY_SCHEME','rsa'),interactive)
+        _credentials.update(data=j,expires=time.monotonic()+ttl)
+        return j[site]['username'], j[site]['password']
+
+def _getUserPass(site,keyScheme,interactive=True):
+    ''' Returns decrypted credentials of every site '''
+    if interactive:
+        print(f'Getting login info for {site}')
 
-    ef = _APP_DIR / 'wt.enc'
-    dk = _APP_DIR / 'wt.pem'
+    ef = _ENC_FILE
 
     header = '\n'.join([
         '='*50,
@@ -262,12 +492,11 @@ def getUserPass(site):
         'Note: Password will not show when typed',
         ''
     ])
-    kp = padding.OAEP(
-        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-        algorithm=hashes.SHA256(),
-        label=None)
 
     def _getValidCredentials():
+        if not interactive:
+            raise WeebException(f'No {site} credentials stored, log in once with the CLI')
+        print(header)
         try:
             username = input('Username: ')
         except KeyboardInterrupt:
@@ -283,23 +512,8 @@ def getUserPass(site):
         return username, password
 
     if ef.is_file():
-
-        if not dk.is_file():
-            raise WeebException(f'ERROR: DECRYPTION KEY {dk} MISSING!!!')
-
-        try:
-            ek = load_pem_private_key(dk.read_bytes(),None)
-        except ValueError as e:
-            print(e)
-            raise WeebException(f'ERROR: DECRYPTION KEY LOAD FAIL, KEY {dk} TAMPERRED??')
-
-        try:
-            ed = pickle.loads(ef.read_bytes())
-        except pickle.UnpicklingError:
-            raise WeebException('Corrupted encrypted file?')
-
-        fk = ek.decrypt(ed['k'],kp)
-        f = Fernet(fk)
+        ed = _loadEncrypted()
+        f = Fernet(_unwrapKey(ed))
 
         try:
             j = json.loads(base64.b64decode(f.decrypt(ed['d'])))
@@ -307,7 +521,6 @@ def getUserPass(site):
             raise WeebException('Decryption failed, encrypted file has been tampered?')
 
         if not j.get(site):
-            print(header)
             username, password = _getValidCredentials()
             j[site] = {
                 'username': username,
@@ -315,9 +528,8 @@ def getUserPass(site):
             }
             ed['d'] = f.encrypt(
                 base64.b64encode(json.dumps(j).encode('utf-8')))
-            ef.write_bytes(pickle.dumps(ed))
+            _writeEncrypted(ed)
     else:
-        print(header)
         username, password = _getValidCredentials()
         j = {
             site: {
@@ -325,25 +537,16 @@ def getUserPass(site):
                 'password': password,
             },
         }
-        ek = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=4096,
-            backend=default_backend())
-        dk.write_bytes(ek.private_bytes(
-            encoding=Encoding.PEM,
-            format=PrivateFormat.PKCS8,
-            encryption_algorithm=NoEncryption()))
-
         fk = Fernet.generate_key()
         ed = {
             'd': Fernet(fk).encrypt(
                 base64.b64encode(json.dumps(j).encode('utf-8'))),
-            'k': ek.public_key().encrypt(fk,kp),
         }
-        ef.write_bytes(pickle.dumps(ed))
+        _wrapKey(ed,fk,keyScheme)
+        _writeEncrypted(ed)
         print(f'Encrypted in {ef}')
 
-    return j[site]['username'], j[site]['password']
+    return j
 
 def getSeleniumDriver(headless=True):
     chrome_options = Options()
@@ -1,2 +1,6 @@
 class WeebException(Exception):
-    pass
+
+    def __init__(self,*args,status=None):
+        super().__init__(*args)
+        # http status of the request that failed, None if it wasn't one
+        self.status = status